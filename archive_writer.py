@@ -0,0 +1,130 @@
+# Buffers lines appended to archive files, so a burst of evictions becomes a single write per file.
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("always", "close", "never")
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+def read_last_lines(path: str, count: int, block_size: int = TAIL_BLOCK_SIZE) -> List[str]:
+    """Return the last count non-empty lines of a file, reading blocks backwards from its end.
+
+    The cost depends on the length of those lines rather than the size of the file.
+    """
+    if count <= 0:
+        return []
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        # One newline more than needed, so the first line kept is known to be complete
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    if position > 0:
+        # Drop the partial first line, it may even start in the middle of a character
+        data = data[data.index(b"\n") + 1:]
+    lines = [line for line in data.decode("utf-8").splitlines() if line.strip()]
+    return lines[-count:]
+
+
+class ArchiveWriter:
+    """Appends lines to files through buffers and handles kept open per file.
+
+    A file's buffer is written out once it holds batch_size lines, once its oldest line is
+    flush_interval seconds old, before the file is read, and at exit. The fsync policy decides
+    when data is forced to disk: after every flush ("always"), only when handles are closed
+    ("close"), or never, leaving it to the OS.
+    """
+
+    def __init__(self, batch_size: int = 32, flush_interval: float = 5.0, fsync: str = "close", max_handles: int = 64):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, not {fsync}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_handles = max_handles  # Least recently used handles are closed beyond this
+        self._buffers: Dict[str, List[str]] = {}
+        self._buffered_since: Dict[str, float] = {}
+        self._handles: "OrderedDict[str, TextIO]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        atexit.register(self.close)
+
+    def write(self, path: str, line: str) -> None:
+        with self._lock:
+            buffer = self._buffers.setdefault(path, [])
+            if not buffer:
+                self._buffered_since[path] = time.monotonic()
+            buffer.append(line)
+            if len(buffer) >= self.batch_size:
+                self._flush(path)
+        self._start_flusher()
+
+    def flush(self, path: Optional[str] = None) -> None:
+        """Write out the buffer of one file, or of all files."""
+        with self._lock:
+            for buffered_path in [path] if path else list(self._buffers):
+                self._flush(buffered_path)
+
+    def _flush(self, path: str) -> None:
+        lines = self._buffers.pop(path, None)
+        self._buffered_since.pop(path, None)
+        if not lines:
+            return
+        try:
+            handle = self._handle(path)
+            handle.write("".join(lines))
+            handle.flush()
+            if self.fsync == "always":
+                os.fsync(handle.fileno())
+        except OSError as e:
+            logger.error(f"Failed to write {len(lines)} lines to {path}: {e}")
+
+    def _handle(self, path: str) -> TextIO:
+        handle = self._handles.get(path)
+        if handle is None:
+            handle = self._handles[path] = open(path, "a")
+            while len(self._handles) > self.max_handles:
+                self._close_handle(*self._handles.popitem(last=False))
+        self._handles.move_to_end(path)
+        return handle
+
+    def _close_handle(self, path: str, handle: TextIO) -> None:
+        try:
+            if self.fsync != "never":
+                handle.flush()
+                os.fsync(handle.fileno())
+            handle.close()
+        except OSError as e:
+            logger.error(f"Failed to close {path}: {e}")
+
+    def _start_flusher(self) -> None:
+        if self._flusher is None and self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="archive-writer", daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval / 2):
+            cutoff = time.monotonic() - self.flush_interval
+            with self._lock:
+                for path in [path for path, since in self._buffered_since.items() if since <= cutoff]:
+                    self._flush(path)
+
+    def close(self) -> None:
+        """Write out every buffer and close the handles, e.g. at shutdown."""
+        self._closed.set()
+        with self._lock:
+            for path in list(self._buffers):
+                self._flush(path)
+            while self._handles:
+                self._close_handle(*self._handles.popitem(last=False))
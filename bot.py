@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# Starts the bot. Stock analysis workers are spawned processes that re-import the main script, so it
+# imports nothing at module level and they only load the stocks module instead of the whole bot.
+
+if __name__ == "__main__":
+    from jarvis import main
+
+    main()
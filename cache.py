@@ -0,0 +1,99 @@
+# A small in-process cache with time-to-live expiry and LRU eviction, optionally persisted to disk as JSON.
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Least recently used cache whose entries expire after a time-to-live."""
+
+    def __init__(self, ttl: float, max_entries: int, path: Optional[str] = None, name: str = "cache"):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path  # JSON file to persist the cache to, values must be JSON serialisable
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expiry as epoch seconds, value), ordered from least to most recently used
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        if self.path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def purge_expired(self) -> None:
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self._entries.items() if expires_at < now]:
+            del self._entries[key]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"{self.hit_rate:.0%} hit rate ({self.hits} hits, {self.misses} misses, {len(self)} entries)"
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+            now = time.time()
+            for key, expires_at, value in entries:
+                if expires_at >= now:
+                    self._entries[key] = (expires_at, value)
+            # Saved from least to most recently used, possibly by a cache with a larger limit
+            self._evict()
+            logger.info(f"Loaded {len(self._entries)} entries into the {self.name} cache")
+        except Exception as e:
+            logger.warning(f"Failed to load the {self.name} cache from {self.path}: {e}")
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        self.purge_expired()
+        try:
+            # Write to a temporary file first so a crash never leaves a half written cache behind
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump([[key, expires_at, value] for key, (expires_at, value) in self._entries.items()], f)
+            os.replace(tmp_path, self.path)
+            logger.debug(f"Saved {len(self._entries)} entries of the {self.name} cache to {self.path}")
+        except Exception as e:
+            logger.warning(f"Failed to save the {self.name} cache to {self.path}: {e}")
@@ -0,0 +1,58 @@
+# Chart rendering for the stock tools, drawing straight onto Agg figures and caching the PNGs by content.
+import hashlib
+import logging
+import os
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ChartRenderer:
+    """Renders charts to PNG files named after what they show, so an unchanged chart is never redrawn."""
+
+    def __init__(self, directory: str, max_age: float = 7 * 24 * 3600, figsize=(12, 6)):
+        self.directory = directory
+        self.max_age = max_age  # Charts not requested for this many seconds are deleted
+        self.figsize = figsize
+
+    def path_for(self, *key) -> str:
+        digest = hashlib.sha1("|".join(str(part) for part in key).encode()).hexdigest()[:20]
+        return os.path.join(self.directory, f"{digest}.png")
+
+    def render(self, key: tuple, draw: Callable) -> str:
+        """Return the PNG for key, calling draw(ax) to plot it only if it isn't cached yet."""
+        plot_file_path = self.path_for(*key)
+        if os.path.exists(plot_file_path):
+            os.utime(plot_file_path)  # Keep frequently requested charts from being pruned
+            logger.debug(f"Chart cache hit for {key}")
+            return plot_file_path
+
+        # Use the Agg canvas directly rather than pyplot, whose global figure registry keeps
+        # every figure alive until it is explicitly closed
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        os.makedirs(self.directory, exist_ok=True)
+        fig = Figure(figsize=self.figsize)
+        FigureCanvasAgg(fig)
+        try:
+            draw(fig.add_subplot())
+            tmp_file = f"{plot_file_path}.{os.getpid()}.tmp"
+            fig.savefig(tmp_file, format="png")
+            os.replace(tmp_file, plot_file_path)
+        finally:
+            fig.clear()
+        logger.debug(f"Chart saved as {plot_file_path}")
+        self.prune()
+        return plot_file_path
+
+    def prune(self) -> None:
+        """Delete charts that haven't been requested within max_age."""
+        cutoff = time.time() - self.max_age
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".png") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"Failed to prune charts in {self.directory}: {e}")
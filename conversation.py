@@ -2,10 +2,14 @@
 import datetime
 import json
 import os
+import re
+import time
 import logging
 import openai
 from dotenv import load_dotenv
 from collections import deque
+from tokens import count_tokens
+from archive_writer import ArchiveWriter, read_last_lines
 
 # Enable logging
 logging.basicConfig(
@@ -15,17 +19,39 @@ logger = logging.getLogger(__name__)
 logger.info("Conversation class loaded...")
 
 class Dialogue:
+    # Thousands of users each keep a memory of these, so keep them compact
+    __slots__ = ("question", "answer", "timestamp", "token_count", "rendered")
+
     def __init__(self):
         self.question = ""
         self.answer = ""
-        self.datetime = ""
+        self.timestamp = None  # Epoch seconds the question was asked, formatted only when rendered
+        self.token_count = None
+        self.rendered = None
 
     def set_question(self, question):
         self.question = question
-        self.datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.timestamp = int(time.time())
+        self.token_count = None
+        self.rendered = None
     
     def set_answer(self, answer):
         self.answer = answer
+        self.token_count = None
+        self.rendered = None
+
+    def render(self):
+        # The dialogue as it appears in the prompt, only re-rendered after it changes
+        if self.rendered is None:
+            text = self.get_datetime()+"\n"+self.question+"\n"
+            text += self.answer+"\n\n" if self.answer != "" else "Jarvis: "
+            self.rendered = text
+        return self.rendered
+
+    def get_token_count(self, model=None):
+        if self.token_count is None:
+            self.token_count = count_tokens(self.render(), model)
+        return self.token_count
 
     def get_question(self):
         return self.question
@@ -34,21 +60,59 @@ class Dialogue:
         return self.answer
     
     def get_datetime(self):
-        return self.datetime
+        if self.timestamp is None:
+            return ""
+        return datetime.datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+MAX_ANSWER_ATTEMPTS = 3
+# e.g. "This model's maximum context length is 4097 tokens, however you requested 4500 tokens (3476 in your prompt; 1024 for the completion)"
+CONTEXT_LENGTH_PATTERN = re.compile(r"maximum context length is (\d+) tokens.*?(\d+) tokens", re.DOTALL)
+
+# OpenAI clients are created once and reused, keeping their connection pools
+_openai_clients = {}
+
+def get_openai_client(async_client=False):
+    if async_client not in _openai_clients:
+        client_class = openai.AsyncAzureOpenAI if async_client else openai.AzureOpenAI
+        _openai_clients[async_client] = client_class(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            api_version=os.getenv("OPENAI_API_VERSION","2022-12-01"),
+            azure_endpoint=os.getenv("OPENAI_API_BASE"),
+        )
+    return _openai_clients[async_client]
+
+# Shared by every conversation, so evicted dialogues are written in batches through open handles
+_archive_writer = None
+
+def get_archive_writer():
+    global _archive_writer
+    if _archive_writer is None:
+        _archive_writer = ArchiveWriter(
+            batch_size=int(os.getenv("ARCHIVE_BATCH_SIZE", 32)),
+            flush_interval=float(os.getenv("ARCHIVE_FLUSH_INTERVAL", 5.0)),
+            fsync=os.getenv("ARCHIVE_FSYNC", "close"),
+        )
+    return _archive_writer
 
 class Conversation:
     def __init__(self, user_id=None):
         # Get environment variables from .env file
         load_dotenv()
+        self.archive_writer = get_archive_writer()
         self.path = os.getenv("PERSISTENCE_PATH","/volumes/persist/")
-        self.memory = []
-        self.token_limit = int(os.getenv("CONTEXT_TOKEN_LIMIT",(4097-1024))) # Token limit 4097 - 1024 for response
         self.memory_size = 50
+        self.memory = deque(maxlen=self.memory_size)
+        # Running token total of the memory, with the size each dialogue was counted at, so the
+        # prompt size is known without rescanning the memory
+        self.memory_tokens = 0
+        self.memory_token_counts = deque()
+        self.token_limit = int(os.getenv("CONTEXT_TOKEN_LIMIT",(4097-1024))) # Token limit 4097 - 1024 for response
         self.user_id = user_id
         self.openai_temp = os.getenv("TEMPERATURE")
         self.openai_top_p = os.getenv("TOP_PROB")
         self.openai_engine = os.getenv("ENGINE")
         self.openai_max_tokens = os.getenv("MAX_TOKENS")
+        self.context_window = int(os.getenv("CONTEXT_WINDOW", 4097)) # Prompt and answer tokens the model accepts
         # Initialise the context from the context.txt file if it exists
         if os.path.exists(self.path+"context.txt"):
             with open(self.path+"context.txt", "r") as f:
@@ -59,18 +123,17 @@ class Conversation:
         if os.path.exists(self.path+"training.jsonl"):
             self.pretrain_using_file(self.path+"training.jsonl")
         # Initialise the memory from self.path+"training_"+self.user_id+".jsonl"
+        # Dialogues archived but still buffered have to be on disk before reading
+        self.archive_writer.flush(self.path+"training_"+self.user_id+".jsonl")
         if os.path.exists(self.path+"training_"+self.user_id+".jsonl"):
             self.populate_memory(self.path+"training_"+self.user_id+".jsonl")
 
-    def get_answer(self, tg_user=None):
-        # Initialise OpenAI
-        openai.api_type = os.getenv("OPENAI_API_TYPE","azure")
-        openai.api_base = os.getenv("OPENAI_API_BASE")
-        openai.api_version = os.getenv("OPENAI_API_VERSION","2022-12-01")
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        try:
-            response = openai.Completion.create(
-            engine=self.openai_engine,
+    def completion_args(self, tg_user=None):
+        # Make room for the answer before sending, rather than finding out from a failed request
+        self.archive_extra_memories()
+        self.trim_memory(self.context_tokens + self.memory_tokens + int(self.openai_max_tokens) - self.context_window)
+        return dict(
+            model=self.openai_engine,
             prompt=self.get_complete_context(),
             temperature=float(self.openai_temp),
             max_tokens=int(self.openai_max_tokens),
@@ -79,26 +142,79 @@ class Conversation:
             presence_penalty=0,
             stop=None,
             user=tg_user)
-        # If the request is invalid due to too many tokens, purge a memory and try again
-        except openai.error.InvalidRequestError as e:
-            logger.error(f"Error: {e}")
-            self.purge_a_memory()
-            return self.get_answer(tg_user)
-        # Return a generic response for any other error
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            return "I'm sorry, I'm not feeling well. I'll be back soon."
-        return response.choices[0].text
+
+    def handle_context_overflow(self, error):
+        # Trim everything the request was over by in one go, one dialogue if the error doesn't say
+        match = CONTEXT_LENGTH_PATTERN.search(str(error))
+        if match:
+            maximum, requested = int(match.group(1)), int(match.group(2))
+            self.trim_memory(requested - maximum)
+        elif len(self.memory) > 1:
+            self.trim_memory(self.memory_token_counts[0])
+
+    def get_answer(self, tg_user=None):
+        for _ in range(MAX_ANSWER_ATTEMPTS):
+            try:
+                response = get_openai_client().completions.create(**self.completion_args(tg_user))
+                return response.choices[0].text
+            # If the request is invalid due to too many tokens, purge memories and try again
+            except openai.BadRequestError as e:
+                logger.error(f"Error: {e}")
+                self.handle_context_overflow(e)
+            # Return a generic response for any other error
+            except Exception as e:
+                logger.error(f"Error: {e}")
+                break
+        return "I'm sorry, I'm not feeling well. I'll be back soon."
+
+    async def get_answer_async(self, tg_user=None):
+        for _ in range(MAX_ANSWER_ATTEMPTS):
+            try:
+                response = await get_openai_client(async_client=True).completions.create(**self.completion_args(tg_user))
+                return response.choices[0].text
+            except openai.BadRequestError as e:
+                logger.error(f"Error: {e}")
+                self.handle_context_overflow(e)
+            except Exception as e:
+                logger.error(f"Error: {e}")
+                break
+        return "I'm sorry, I'm not feeling well. I'll be back soon."
         
     def add_to_memory(self, dialogue):
+        self.refresh_newest_memory()
         while (len(self.memory) >= self.memory_size):
             self.purge_a_memory()
-        self.memory.append(dialogue)
+        self.append_memory(dialogue)
         self.archive_extra_memories()
 
+    def append_memory(self, dialogue):
+        tokens = dialogue.get_token_count(self.openai_engine)
+        if len(self.memory) == self.memory_size:
+            # Only when loading history, the deque drops its oldest dialogue without archiving it
+            self.memory_tokens -= self.memory_token_counts.popleft()
+        self.memory.append(dialogue)
+        self.memory_token_counts.append(tokens)
+        self.memory_tokens += tokens
+
     def purge_a_memory(self):
-        self.add_to_training_file(self.memory[0])
-        self.memory.pop(0)
+        self.add_to_training_file(self.memory.popleft())
+        self.memory_tokens -= self.memory_token_counts.popleft()
+
+    def trim_memory(self, tokens):
+        # Archive the oldest dialogues until at least tokens have been freed, keeping the question being asked
+        freed = 0
+        while freed < tokens and len(self.memory) > 1:
+            freed += self.memory_token_counts[0]
+            self.purge_a_memory()
+        if freed:
+            logging.debug(f"Trimmed {freed} tokens of dialogues from the memory")
+
+    def refresh_newest_memory(self):
+        # Answers are filled in after a dialogue is added, so only the newest dialogue can have changed
+        if self.memory:
+            tokens = self.memory[-1].get_token_count(self.openai_engine)
+            self.memory_tokens += tokens - self.memory_token_counts[-1]
+            self.memory_token_counts[-1] = tokens
         
     def get_memory(self):
         return self.memory
@@ -107,54 +223,44 @@ class Conversation:
         return self.context
 
     def populate_memory(self, memory_file):
-        with open(memory_file, "r") as f:
-            # Use a deque to keep track of the last 50 lines of the file
-            last_lines = deque(maxlen = self.memory_size)
-            for line in f:
-                # Add the line to the deque
-                last_lines.append(line)
-            for line in last_lines:
-                dialogue = Dialogue()
-                # Parse the json line into a dialogue object
-                # e.g. {"prompt": "Human: Hello, pleased to meet you, my name is Yusuf", "completion": "Jarvis thinks: What a friendly person, looking forward to finding out more.\nJarvis: Hi Yusuf, it's a pleasure to meet you too."}
-                line = json.loads(line)
-                dialogue.set_question(line["prompt"].replace("Human: ",self.user_id+": "))
-                dialogue.set_answer(line["completion"].rstrip('\n'))
-                self.memory.append(dialogue)
+        # Only read the last memory_size lines, seeking back from the end of the file
+        for line in read_last_lines(memory_file, self.memory_size):
+            dialogue = Dialogue()
+            # Parse the json line into a dialogue object
+            # e.g. {"prompt": "Human: Hello, pleased to meet you, my name is Yusuf", "completion": "Jarvis thinks: What a friendly person, looking forward to finding out more.\nJarvis: Hi Yusuf, it's a pleasure to meet you too."}
+            line = json.loads(line)
+            dialogue.set_question(line["prompt"].replace("Human: ",self.user_id+": "))
+            dialogue.set_answer(line["completion"].rstrip('\n'))
+            self.append_memory(dialogue)
     
     def add_to_training_file(self, dialogue):
-        with open(self.path+"training_"+self.user_id+".jsonl", "a+") as f:
-            f.write(json.dumps({"prompt": dialogue.get_question(), "completion": dialogue.get_answer()})+"\n")
+        self.archive_writer.write(self.path+"training_"+self.user_id+".jsonl", json.dumps({"prompt": dialogue.get_question(), "completion": dialogue.get_answer()})+"\n")
 
     def get_complete_context(self):
         self.archive_extra_memories()
-        complete_context = self.context+"\n\n"
-        # iterate through memory and add to context
-        for dialogue in self.memory:
-            complete_context += dialogue.get_datetime()+"\n"
-            complete_context += dialogue.get_question()+"\n"
-            if dialogue.get_answer() != "":
-                complete_context += dialogue.get_answer()+"\n\n"
-            else:
-                complete_context += "Jarvis: "
+        complete_context = "".join([self.context_prefix, *(dialogue.render() for dialogue in self.memory)])
         logging.debug("Context: "+complete_context)
         return complete_context
 
     def archive_extra_memories(self):
         # Trim the context to the within the token limit
-        context_size = len(self.context)
-        for dialogue in self.memory:
-            context_size += len(dialogue.get_question())+1
-            if dialogue.get_answer() != "":
-                context_size += len(dialogue.get_answer())+2
-            else:
-                context_size += 8
-
-        while (context_size > self.token_limit*4):
-            logging.debug("Context size: "+str(context_size)+", cutting a few dialogues from the memory...")
-            self.add_to_training_file(self.memory[0])
-            dialog = self.memory.pop(0)
-            context_size -= len(dialog.get_question())+1 + len(dialog.get_answer())+2
+        self.refresh_newest_memory()
+        context_size = self.context_tokens + self.memory_tokens
+        while (context_size > self.token_limit and self.memory):
+            logging.debug("Context size: "+str(context_size)+" tokens, cutting a few dialogues from the memory...")
+            self.purge_a_memory()
+            context_size = self.context_tokens + self.memory_tokens
+
+    @property
+    def context(self):
+        return self._context
+
+    @context.setter
+    def context(self, context):
+        # The static start of every prompt, rendered and counted once
+        self._context = context
+        self.context_prefix = context+"\n\n"
+        self.context_tokens = count_tokens(self.context_prefix, self.openai_engine)
     
     def set_context(self, context):
         self.context = context
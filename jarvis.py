@@ -8,7 +8,7 @@ First, a few callback functions are defined. Then, those functions are passed to
 registered at their respective places. Then, the bot is started and runs until we press Ctrl-C on the
 command line.
 Usage:
-ConversationBot example, ConversationHandler and PicklePersistence.
+ConversationBot example, ConversationHandler and SQLite backed persistence.
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
@@ -17,12 +17,14 @@ import logging
 import os
 from autogen_agentchat.agents import AssistantAgent
 from autogen_ext.models.openai import AzureOpenAIChatCompletionClient
-from autogen_ext.tools.mcp import mcp_server_tools, SseServerParams
-from autogen_agentchat.messages import TextMessage
+from autogen_ext.tools.mcp import SseServerParams
+from autogen_agentchat.base import Response
+from autogen_agentchat.messages import ModelClientStreamingChunkEvent, TextMessage, ToolCallRequestEvent
 from autogen_core.tools import FunctionTool
 from autogen_core import CancellationToken
 from autogen_core.memory import MemoryContent, MemoryMimeType, ListMemory
 from autogen_core.model_context import BufferedChatCompletionContext
+from autogen_core.models import ChatCompletionClient, LLMMessage, UserMessage
 from dotenv import load_dotenv
 import time
 import traceback
@@ -34,7 +36,6 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
 )
 from telegram.error import TelegramError
@@ -42,10 +43,28 @@ import telegramify_markdown
 from telegramify_markdown.interpreters import BaseInterpreter, MermaidInterpreter
 from telegramify_markdown.type import ContentTypes
 import asyncio
-from telegramify_markdown.interpreters import TextInterpreter, MermaidInterpreter
+from telegramify_markdown.interpreters import InterpreterChain, TextInterpreter, MermaidInterpreter
 import telegramify_markdown.customize as customize
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+from collections import OrderedDict
 from functools import lru_cache
+from search import WebSearch
+from cache import TTLCache
+from stocks import StockAnalysisPool
+from mcp_registry import McpToolRegistry
+from user_queue import UserWorkQueue
+from token_context import TokenBudgetChatCompletionContext
+from tokens import get_encoding
+from vector_memory import VectorMemory
+from streaming import ProgressiveReply
+from rate_limiter import ChatRateLimiter
+from throttled_client import ThrottledChatCompletionClient, current_user
+from response_cache import CachedChatCompletionClient
+from model_router import SMALL, ModelRouter, classify, model_route
+import openai
+from sqlite_persistence import SqlitePersistence
+from webhook_server import run_webhook_server
+import metrics
 
 # Get environment variables from .env file
 from dotenv import load_dotenv
@@ -83,16 +102,6 @@ use_mcp = os.getenv("ENABLE_MCP_SERVER", "False").lower() == "true"
 
 CONVERSATION = range(1)
 
-client = AzureOpenAIChatCompletionClient(
-    azure_deployment=os.getenv("AZURE_DEPLOYMENT_NAME"),
-    model=os.getenv("AZURE_DEPLOYMENT_NAME"),
-    api_version=os.getenv("AZURE_API_VERSION"),
-    azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-    api_key=os.getenv("AZURE_API_KEY"),
-    max_retries=3,
-    timeout=30.0
-)
-
 # Initialise the system message from the context.txt file if it exists
 path = os.getenv("PERSISTENCE_PATH","/volumes/persist/")
 if os.path.exists(path+"context.txt"):
@@ -101,165 +110,108 @@ if os.path.exists(path+"context.txt"):
 else:
     system_message = "You have a personality like the Marvel character Jarvis. You are curious, helpful, creative, very witty and a bit sarcastic."
 
-def google_search(query: str, num_results: int = 2, max_chars: int = 500) -> list:  # type: ignore[type-arg]
-    import requests
-    from bs4 import BeautifulSoup
-
-    api_key = os.getenv("GOOGLE_API_KEY")
-    search_engine_id = os.getenv("GOOGLE_SEARCH_ENGINE_ID")
-
-    if not api_key or not search_engine_id:
-        raise ValueError("API key or Search Engine ID not found in environment variables")
-
-    url = "https://customsearch.googleapis.com/customsearch/v1"
-    params = {"key": str(api_key), "cx": str(search_engine_id), "q": str(query), "num": str(num_results)}
-
-    response = requests.get(url, params=params)
-
-    if response.status_code != 200:
-        logger.debug(response.json())
-        raise Exception(f"Error in API request: {response.status_code}")
+# Search caches are shared by every agent, and optionally persisted across restarts
+persist_search_cache = os.getenv("SEARCH_CACHE_PERSIST", "False").lower() == "true"
+search_results_cache = TTLCache(
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", 900)),
+    max_entries=int(os.getenv("SEARCH_CACHE_SIZE", 256)),
+    path=path+"search_cache.json" if persist_search_cache else None,
+    name="search results",
+)
+search_pages_cache = TTLCache(
+    ttl=float(os.getenv("PAGE_CACHE_TTL", 3600)),
+    max_entries=int(os.getenv("PAGE_CACHE_SIZE", 1024)),
+    path=path+"page_cache.json" if persist_search_cache else None,
+    name="search pages",
+)
 
-    results = response.json().get("items", [])
+# Repeated requests, like the summarization prompt or a question the agent answered without calling
+# a tool, are answered from a cache. Turns that called tools are only cached with RESPONSE_CACHE_TOOL_TURNS.
+response_cache = TTLCache(
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 512)),
+    path=path+"response_cache.json" if os.getenv("RESPONSE_CACHE_PERSIST", "False").lower() == "true" else None,
+    name="model responses",
+)
+use_response_cache = os.getenv("RESPONSE_CACHE", "True").lower() == "true"
+throttled_clients: Dict[str, ThrottledChatCompletionClient] = {}
+
+def build_client(deployment: str, env_prefix: str) -> ChatCompletionClient:
+    """Client for one Azure deployment, with its own rate limits in front of the shared response cache."""
+    azure_client = AzureOpenAIChatCompletionClient(
+        azure_deployment=deployment,
+        model=deployment,
+        api_version=os.getenv("AZURE_API_VERSION"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        api_key=os.getenv("AZURE_API_KEY"),
+        max_retries=0,  # Retries are scheduled by the throttled client, shared by all users
+        timeout=30.0
+    )
+    throttled_client = throttled_clients[deployment] = ThrottledChatCompletionClient(
+        azure_client,
+        name=deployment,
+        requests_per_minute=float(os.getenv(f"{env_prefix}_REQUESTS_PER_MINUTE", 60)),
+        tokens_per_minute=float(os.getenv(f"{env_prefix}_TOKENS_PER_MINUTE", 60000)),
+        max_retries=int(os.getenv("AZURE_MAX_RETRIES", 5)),
+    )
+    if not use_response_cache:
+        return throttled_client
+    return CachedChatCompletionClient(
+        throttled_client,
+        response_cache,
+        model=deployment,
+        cache_tool_turns=os.getenv("RESPONSE_CACHE_TOOL_TURNS", "False").lower() == "true",
+    )
 
-    def get_page_content(url: str) -> str:
-        try:
-            response = requests.get(url, timeout=10)
-            soup = BeautifulSoup(response.content, "html.parser")
-            text = soup.get_text(separator=" ", strip=True)
-            words = text.split()
-            content = ""
-            for word in words:
-                if len(content) + len(word) + 1 > max_chars:
-                    break
-                content += " " + word
-            return content.strip()
-        except Exception as e:
-            logger.error(f"Error fetching {url}: {str(e)}")
-            return ""
-
-    enriched_results = []
-    for item in results:
-        body = get_page_content(item["link"])
-        enriched_results.append(
-            {"title": item["title"], "link": item["link"], "snippet": item["snippet"], "body": body}
-        )
-        time.sleep(1)  # Be respectful to the servers
-    
-    # Convert the response to a chat friendly, markdown format response
-    response = ""
-    for result in enriched_results:
-        response += f"## {result['title']}\n\n"
-        response += f"**Snippet:** {result['snippet']}\n\n"
-        response += f"**Content:**\n{result['body']}\n\n"
-        response += "---\n\n"  # Horizontal rule between results
+# Small talk and summarization go to the small deployment when one is configured
+small_deployment = os.getenv("AZURE_SMALL_DEPLOYMENT_NAME")
+small_model_max_words = int(os.getenv("SMALL_MODEL_MAX_WORDS", 12))
+client = build_client(os.getenv("AZURE_DEPLOYMENT_NAME"), "AZURE")
+if small_deployment:
+    client = ModelRouter(large=client, small=build_client(small_deployment, "AZURE_SMALL"))
+
+web_search = WebSearch(
+    api_key=os.getenv("GOOGLE_API_KEY"),
+    search_engine_id=os.getenv("GOOGLE_SEARCH_ENGINE_ID"),
+    per_host_limit=int(os.getenv("SEARCH_PER_HOST_LIMIT", 2)),
+    host_delay=float(os.getenv("SEARCH_HOST_DELAY", 1.0)),
+    deadline=float(os.getenv("SEARCH_DEADLINE", 15.0)),
+    max_page_bytes=int(os.getenv("SEARCH_MAX_PAGE_BYTES", 1024 * 1024)),
+    results_cache=search_results_cache,
+    pages_cache=search_pages_cache,
+)
 
-    return response
+async def google_search(query: str, num_results: int = 2, max_chars: int = 500) -> str:
+    return await web_search.search(query, num_results, max_chars)
 
 def current_time() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-def analyze_stock(ticker: str) -> dict:  # type: ignore[type-arg]
-    import os
-    from datetime import datetime, timedelta
-    import matplotlib
-    matplotlib.use('Agg')  # Must be before any pyplot import
-    import matplotlib.pyplot as plt
-    import numpy as np
-    import pandas as pd
-    import yfinance as yf
-    from pytz import timezone  # type: ignore
-
-    stock = yf.Ticker(ticker)
-
-    # Get historical data (1 year of data to ensure we have enough for 200-day MA)
-    end_date = datetime.now(timezone("UTC"))
-    start_date = end_date - timedelta(days=365)
-    hist = stock.history(start=start_date, end=end_date)
-
-    # Ensure we have data
-    if hist.empty:
-        return {"error": "No historical data available for the specified ticker."}
-
-    # Compute basic statistics and additional metrics
-    current_price = stock.info.get("currentPrice", hist["Close"].iloc[-1])
-    year_high = stock.info.get("fiftyTwoWeekHigh", hist["High"].max())
-    year_low = stock.info.get("fiftyTwoWeekLow", hist["Low"].min())
-
-    # Calculate 50-day and 200-day moving averages
-    ma_50 = hist["Close"].rolling(window=50).mean().iloc[-1]
-    ma_200 = hist["Close"].rolling(window=200).mean().iloc[-1]
-
-    # Calculate YTD price change and percent change
-    ytd_start = datetime(end_date.year, 1, 1, tzinfo=timezone("UTC"))
-    ytd_data = hist.loc[ytd_start:]  # type: ignore[misc]
-    if not ytd_data.empty:
-        price_change = ytd_data["Close"].iloc[-1] - ytd_data["Close"].iloc[0]
-        percent_change = (price_change / ytd_data["Close"].iloc[0]) * 100
-    else:
-        price_change = percent_change = np.nan
-
-    # Determine trend
-    if pd.notna(ma_50) and pd.notna(ma_200):
-        if ma_50 > ma_200:
-            trend = "Upward"
-        elif ma_50 < ma_200:
-            trend = "Downward"
-        else:
-            trend = "Neutral"
-    else:
-        trend = "Insufficient data for trend analysis"
-
-    # Calculate volatility (standard deviation of daily returns)
-    daily_returns = hist["Close"].pct_change().dropna()
-    volatility = daily_returns.std() * np.sqrt(252)  # Annualized volatility
-
-    # Create result dictionary
-    result = {
-        "ticker": ticker,
-        "current_price": current_price,
-        "52_week_high": year_high,
-        "52_week_low": year_low,
-        "50_day_ma": ma_50,
-        "200_day_ma": ma_200,
-        "ytd_price_change": price_change,
-        "ytd_percent_change": percent_change,
-        "trend": trend,
-        "volatility": volatility,
-    }
-
-    # Convert numpy types to Python native types for better JSON serialization
-    for key, value in result.items():
-        if isinstance(value, np.generic):
-            result[key] = value.item()
-
-    # Generate plot
-    plt.figure(figsize=(12, 6))
-    plt.plot(hist.index, hist["Close"], label="Close Price")
-    plt.plot(hist.index, hist["Close"].rolling(window=50).mean(), label="50-day MA")
-    plt.plot(hist.index, hist["Close"].rolling(window=200).mean(), label="200-day MA")
-    plt.title(f"{ticker} Stock Price (Past Year)")
-    plt.xlabel("Date")
-    plt.ylabel("Price ($)")
-    plt.legend()
-    plt.grid(True)
-
-    # Save plot to file
-    os.makedirs(path+"/stocks", exist_ok=True)
-    plot_file_path = f"{path}/stocks/{ticker}_stockprice.png"
-    plt.savefig(plot_file_path)
-    logger.debug(f"Plot saved as {plot_file_path}")
-    result["plot_file_path"] = plot_file_path
-
-    return result
+stock_pool = StockAnalysisPool(
+    path,
+    workers=int(os.getenv("STOCK_POOL_WORKERS", 2)),
+    timeout=float(os.getenv("STOCK_ANALYSIS_TIMEOUT", 60.0)),
+    sync_interval=float(os.getenv("STOCK_SYNC_INTERVAL", 900.0)),
+)
+
+async def analyze_stock(ticker: str, cancellation_token: CancellationToken) -> dict:  # type: ignore[type-arg]
+    return await stock_pool.analyze(ticker, cancellation_token)
+
+async def compare_stocks(tickers: List[str], cancellation_token: CancellationToken) -> dict:  # type: ignore[type-arg]
+    return await stock_pool.compare(tickers, cancellation_token)
 
 # Setup tools
 google_search_tool = FunctionTool(
     google_search, description="Search Google for current, up to date information and facts, returns results with a snippet and body content"
 )
 stock_analysis_tool = FunctionTool(analyze_stock, description="Analyze stock data and generate a plot")
+stock_comparison_tool = FunctionTool(
+    compare_stocks, description="Analyze and compare several stocks at once and generate one combined plot, use this instead of calling the stock analysis tool once per ticker"
+)
 time_tool = FunctionTool(current_time, description="Get the current time")
+for tool in (google_search_tool, stock_analysis_tool, stock_comparison_tool, time_tool):
+    metrics.instrument_tool(tool)
 
 # Home Assistant tools
 homeassistant_server_params = SseServerParams(
@@ -268,39 +220,56 @@ homeassistant_server_params = SseServerParams(
         "Authorization": "Bearer " + mcp_auth_token
     },
     timeout=30
-)  
+)
+mcp_registry = McpToolRegistry(
+    homeassistant_server_params,
+    refresh_interval=float(os.getenv("MCP_REFRESH_INTERVAL", 3600)),
+    health_interval=float(os.getenv("MCP_HEALTH_INTERVAL", 60)),
+)
 
 # Add this after the client initialization
 class AgentManager:
-    _instances: Dict[str, AssistantAgent] = {}
-    
+    # Bounded pool of agents ordered from least to most recently used. Evicted agents are rebuilt
+    # from the memories and chat context persisted in chat_data on the user's next message.
+    _instances: "OrderedDict[str, AssistantAgent]" = OrderedDict()
+    _last_used: Dict[str, float] = {}
+    _tool_versions: Dict[str, int] = {}
+    max_agents = max(1, int(os.getenv("AGENT_POOL_SIZE", 50)))
+    idle_ttl = float(os.getenv("AGENT_IDLE_TTL", 3600))
+    evictions = 0
+
     @classmethod
     async def get_agent(
         cls, 
         user_id: str, 
-        memories: Optional[ListMemory] = None, 
-        chat_context: Optional[BufferedChatCompletionContext] = None
+        memories: Optional[VectorMemory] = None, 
+        chat_context: Optional[TokenBudgetChatCompletionContext] = None
     ) -> AssistantAgent:
         """Get or create an agent instance for the given user_id."""
-       
-        if user_id not in cls._instances:
-            logger.info(f"Creating new agent instance for user {user_id}")
-            tools = [google_search_tool, stock_analysis_tool, time_tool]
+        cls.evict_idle()
+
+        # Rebuild agents holding MCP tools that have since been replaced
+        if user_id in cls._tool_versions and cls._tool_versions[user_id] != mcp_registry.version:
+            logger.info(f"Home Assistant tools changed, rebuilding agent instance for user {user_id}")
+            cls.clear_agent(user_id)
+
+        if user_id in cls._instances:
+            cls._instances.move_to_end(user_id)
+        else:
+            if chat_context is not None and len(getattr(chat_context, "_messages", [])) > 0:
+                logger.info(f"Rehydrating agent instance for user {user_id} from chat data")
+            else:
+                logger.info(f"Creating new agent instance for user {user_id}")
+            tools = [google_search_tool, stock_analysis_tool, stock_comparison_tool, time_tool]
             
-            if use_mcp:
-                logger.info("Using MCP server tools for Home Assistant integration")
-                # Try connecting to Home Assistant tools for master user
-                if user_id == str(master_id):
-                    try:
-                        mcp_tools = await mcp_server_tools(homeassistant_server_params)
-                        if isinstance(mcp_tools, list):
-                            tools.extend(mcp_tools)
-                            logger.info("Home Assistant tools initialized successfully.")
-                        else:
-                            logger.warning("Home Assistant tools returned invalid format")
-                    except Exception as e:
-                        logger.warning(f"Failed to initialize HomeAssistant tools: {str(e)}")
-                
+            if use_mcp and user_id == str(master_id):
+                # Home Assistant tools for the master user, never wait on the MCP server here
+                if mcp_registry.tools:
+                    tools.extend(metrics.instrument_tool(tool) for tool in mcp_registry.tools)
+                else:
+                    logger.warning("Home Assistant tools are not available yet")
+                cls._tool_versions[user_id] = mcp_registry.version
+
             # Create new agent instance
             cls._instances[user_id] = AssistantAgent(
                 name="Jarvis",
@@ -309,20 +278,73 @@ class AgentManager:
                 system_message=system_message,
                 memory=[memories] if memories else [],
                 reflect_on_tool_use=True,
-                model_context=chat_context
+                model_context=chat_context,
+                model_client_stream=stream_replies
             )
-                
+            cls._evict_overflow()
+
+        cls._last_used[user_id] = time.monotonic()
         return cls._instances[user_id]
 
+    @classmethod
+    def evict_idle(cls) -> None:
+        """Drop agents that haven't been used within the idle TTL."""
+        cutoff = time.monotonic() - cls.idle_ttl
+        # The pool is in LRU order, so the idle agents are all at the front
+        while cls._instances:
+            user_id = next(iter(cls._instances))
+            if cls._last_used.get(user_id, 0) >= cutoff:
+                break
+            cls._evict(user_id, "idle")
+
+    @classmethod
+    def _evict_overflow(cls) -> None:
+        while len(cls._instances) > cls.max_agents:
+            cls._evict(next(iter(cls._instances)), "pool full")
+
+    @classmethod
+    def _evict(cls, user_id: str, reason: str) -> None:
+        del cls._instances[user_id]
+        cls._last_used.pop(user_id, None)
+        cls._tool_versions.pop(user_id, None)
+        cls.evictions += 1
+        logger.info(f"Evicted agent instance for user {user_id} ({reason})")
+
+    @classmethod
+    def stats(cls) -> str:
+        return f"{len(cls._instances)}/{cls.max_agents} resident, {cls.evictions} evicted"
+
     @classmethod
     def clear_agent(cls, user_id: str) -> None:
         """Remove an agent instance for the given user_id."""
         if user_id in cls._instances:
             del cls._instances[user_id]
+            cls._last_used.pop(user_id, None)
+            cls._tool_versions.pop(user_id, None)
             logger.info(f"Cleared agent instance for user {user_id}")
 
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))
+summary_token_budget = int(os.getenv("SUMMARY_TOKEN_BUDGET", 2000))
+summarizing_users: set = set()
+background_tasks: set = set()
+
+# Show replies as they are generated, by editing a placeholder message
+stream_replies = os.getenv("STREAM_REPLIES", "True").lower() == "true"
+stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+
+user_queue = UserWorkQueue(coalesce=os.getenv("COALESCE_MESSAGES", "True").lower() == "true")
+
+memory_settings = dict(
+    k=int(os.getenv("MEMORY_TOP_K", 5)),
+    max_entries=int(os.getenv("MEMORY_MAX_ENTRIES", 500)),
+    max_age_days=float(os.getenv("MEMORY_MAX_AGE_DAYS", 180)),
+)
+
+def new_memory(contents: Optional[List[MemoryContent]] = None) -> VectorMemory:
+    return VectorMemory.from_contents(contents or [], **memory_settings)
+
 # Setup agents
-async def get_agent(user_id: str, memories: ListMemory, chat_context: BufferedChatCompletionContext) -> AssistantAgent:
+async def get_agent(user_id: str, memories: VectorMemory, chat_context: TokenBudgetChatCompletionContext) -> AssistantAgent:
     return await AgentManager.get_agent(user_id, memories, chat_context)
 
 #search_agent = AssistantAgent(
@@ -333,21 +355,34 @@ async def get_agent(user_id: str, memories: ListMemory, chat_context: BufferedCh
 #    system_message="You are a helpful AI assistant. Solve tasks using your tools.",
 #)
 
+# Rendering is configured once, the interpreters hold no per-message state
+customize.strict_markdown = False  # Allow for more flexible markdown parsing
+render_chain = InterpreterChain([TextInterpreter(), MermaidInterpreter(session=None)])
+
+# Paces sends to stay within Telegram's per chat and global limits
+send_limiter = ChatRateLimiter(
+    rate=float(os.getenv("SEND_RATE_PER_CHAT", 1.0)),
+    burst=float(os.getenv("SEND_BURST_PER_CHAT", 3)),
+    global_rate=float(os.getenv("SEND_RATE_GLOBAL", 30)),
+)
+
+@metrics.timed("send")
 async def send_formatted_message(update: Update, message: str) -> None:
-    # Configure mermaid settings
-    customize.strict_markdown = False  # Allow for more flexible markdown parsing
-    
+    # A single pass converts and splits the message, so splits never land inside a Markdown entity
     boxs = await telegramify_markdown.telegramify(
         content=message,
-        interpreters_use=[TextInterpreter(), MermaidInterpreter(session=None)],
+        interpreters_use=render_chain,
         latex_escape=True,
         normalize_whitespace=True,
-        max_word_count=4096
+        max_word_count=4090
     )
     
     for item in boxs:
         logger.debug(f"Processing message item type: {item.content_type}")
-        await asyncio.sleep(0.2)
+        if item.content_type == ContentTypes.TEXT and not item.content.strip():
+            # The Mermaid interpreter can leave an empty text item, which Telegram rejects
+            continue
+        await send_limiter.acquire(update.effective_chat.id)
         try:
             if item.content_type == ContentTypes.TEXT:
                 logger.debug("Sending TEXT message")
@@ -392,7 +427,82 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.warning(f"Unauthorized access denied for user {user_handle} with id {user_id} and name {user_first_name} {user_last_name}.")
         await update.message.reply_text(text="You're not authorized to use this bot. Please contact the bot owner.", parse_mode='MarkdownV2')
         return CONVERSATION
-    
+
+    # Run this user's turns one at a time, messages sent meanwhile are queued behind the current turn
+    await user_queue.submit(user_id, update, lambda updates: respond(updates, context))
+    return CONVERSATION
+
+def schedule_summarization(user_id: str, memories: VectorMemory, chat_context: TokenBudgetChatCompletionContext) -> None:
+    """Start summarizing the user's chat history in the background once it exceeds the token budget."""
+    if user_id in summarizing_users or chat_context.total_tokens() < summary_token_budget:
+        return
+    # Keep the last exchange verbatim from the user's question on, with its memories and tool calls,
+    # and summarize everything before it
+    messages = chat_context._messages
+    last_question = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], UserMessage)), 0)
+    if last_question == 0:
+        return
+    summarizing_users.add(user_id)
+    task = asyncio.create_task(summarize_conversation(user_id, memories, chat_context, messages[:last_question]))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+@metrics.timed("summarize")
+async def summarize_conversation(user_id: str, memories: VectorMemory, chat_context: TokenBudgetChatCompletionContext, messages: List[LLMMessage]) -> None:
+    """Summarize these messages of the chat history into memory and remove them from the context."""
+    model_route.set(SMALL)  # This runs as its own task, so the user's next turn is routed independently
+    try:
+        messages_text = "\n".join([f"{getattr(msg, 'source', 'system')}: {getattr(msg, 'content', str(msg))}" for msg in messages])
+        summary_prompt = f"Summarize this conversation, focusing on key facts, preferences, and context:\n{messages_text}"
+        summary_response = await client.create([UserMessage(content=summary_prompt, source="user")])
+        summary = summary_response.content if isinstance(summary_response.content, str) else "Conversation summary unavailable"
+
+        # Nothing below yields to the event loop, so the next turn sees either the old history or the
+        # summary with the compressed history, never a mix. Messages added or discarded while summarizing
+        # shift positions, so remove the summarized messages themselves rather than the first few.
+        await memories.add(MemoryContent(
+            content=f"Conversation summary: {summary}",
+            mime_type=MemoryMimeType.TEXT,
+            metadata={"timestamp": datetime.now().isoformat(), "type": "summary"}
+        ))
+        chat_context.remove_messages(messages)
+        logger.info(f"Summarized and compressed chat history for user {user_id}")
+    except Exception as e:
+        logger.warning(f"Failed to summarize conversation: {e}")
+    finally:
+        summarizing_users.discard(user_id)
+
+async def stream_turn(agent: AssistantAgent, user_content: TextMessage, update: Update) -> Response:
+    """Run the agent's turn, showing the reply in a placeholder message while it is generated."""
+    reply = ProgressiveReply(update.message, interval=stream_edit_interval)
+    await reply.start()
+    try:
+        async for event in agent.on_messages_stream([user_content], cancellation_token=CancellationToken()):
+            if isinstance(event, ModelClientStreamingChunkEvent):
+                await reply.append(event.content)
+            elif isinstance(event, ToolCallRequestEvent):
+                # Text streamed before a tool call isn't part of the final answer
+                await reply.status("🔧 " + ", ".join(call.name for call in event.content) + "…")
+            elif isinstance(event, Response):
+                return event
+    finally:
+        # The complete reply is sent formatted once the turn is done
+        await reply.finish()
+    raise RuntimeError("Agent stream ended without a response")
+
+@metrics.timed("turn")
+async def respond(updates: List[Update], context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer one or more queued messages from a user in a single turn."""
+    update = updates[-1]
+    user_id = str(update.effective_user.id)
+    user_handle = update.effective_user.username or "Unknown"
+    user_message = "\n\n".join(queued.message.text for queued in updates)
+    current_user.set(user_id)  # Model requests are queued fairly per user
+    if isinstance(client, ModelRouter):
+        route = classify(user_message, small_model_max_words)
+        model_route.set(route)
+        logger.info(f"Routing turn for user {user_id} to the {route} model ({len(user_message.split())} words)")
+
     memories = None
     chat_context = None
       
@@ -401,61 +511,58 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(f"Existing conversation found for user {user_handle} with id {user_id}")
         memories = context.chat_data["memories"]
         chat_context = context.chat_data["chat_context"]
+        if isinstance(chat_context, BufferedChatCompletionContext):
+            # Migrate contexts persisted before token budgeting, the agent still holds the old one
+            chat_context = TokenBudgetChatCompletionContext(context_token_budget, initial_messages=chat_context._messages)
+            context.chat_data["chat_context"] = chat_context
+            AgentManager.clear_agent(user_id)
+        if isinstance(memories, ListMemory):
+            # Index memories persisted before retrieval, the agent still holds the old list
+            memories = new_memory(memories.content)
+            context.chat_data["memories"] = memories
+            AgentManager.clear_agent(user_id)
     else:
         logger.info(f"New user detected: {user_handle} with id {user_id}")
-        memories = ListMemory()
+        memories = new_memory()
         context.chat_data["memories"] = memories
-        chat_context = BufferedChatCompletionContext(buffer_size=10)
+        chat_context = TokenBudgetChatCompletionContext(context_token_budget)
         context.chat_data["chat_context"] = chat_context
 
-    # Check if chat buffer is full and needs summarization
-    if hasattr(chat_context, '_messages') and len(chat_context._messages) >= 8:
-        # Summarize the conversation and store in memory
-        messages_text = "\n".join([f"{getattr(msg, 'source', 'system')}: {getattr(msg, 'content', str(msg))}" for msg in chat_context._messages[:-2]])
-        summary_prompt = f"Summarize this conversation, focusing on key facts, preferences, and context:\n{messages_text}"
-        
-        try:
-            summary_response = await client.create([{"role": "user", "content": summary_prompt}])
-            summary = summary_response.content[0].text if summary_response.content else "Conversation summary unavailable"
-            
-            await memories.add(MemoryContent(
-                content=f"Conversation summary: {summary}",
-                mime_type=MemoryMimeType.TEXT,
-                metadata={"timestamp": datetime.now().isoformat(), "type": "summary"}
-            ))
-            
-            # Reset chat context to keep only last 2 messages
-            chat_context = BufferedChatCompletionContext(buffer_size=10)
-            context.chat_data["chat_context"] = chat_context
-            logger.info(f"Summarized and compressed chat history for user {user_id}")
-        except Exception as e:
-            logger.warning(f"Failed to summarize conversation: {e}")
-    
     # Get the singleton agent instance
     agent = await AgentManager.get_agent(user_id, memories, chat_context)
-    user_content = TextMessage(content=update.message.text, source="user")
-    logger.debug(f"User-{user_handle}: {update.message.text}")
+    user_content = TextMessage(content=user_message, source="user")
+    logger.debug(f"User-{user_handle}: {user_message}")
 
     try:
-        response = await agent.on_messages(
-            [user_content],
-            cancellation_token=CancellationToken()
-        )
+        if stream_replies:
+            response = await stream_turn(agent, user_content, update)
+        else:
+            response = await agent.on_messages(
+                [user_content],
+                cancellation_token=CancellationToken()
+            )
     except Exception as e:
-        if "429" in str(e):
+        if isinstance(e, openai.RateLimitError) or "429" in str(e):
             await update.message.reply_text("I'm experiencing high demand right now. Please try again in a moment.")
-            return CONVERSATION
+            return
         raise e
 
     # Debug messages in useful format
     logger.debug(f"Jarvis thoughts: {response.inner_messages}")
     logger.debug(f"Jarvis: {response.chat_message}")
 
+    # Log the prompt tokens of every model call this turn made, tool calls included
+    usages = [msg.models_usage for msg in [*(response.inner_messages or []), response.chat_message] if getattr(msg, "models_usage", None)]
+    logger.info(
+        f"Prompt tokens for user {user_id}: {sum(usage.prompt_tokens for usage in usages)} over {len(usages)} model calls, "
+        f"history {chat_context.last_prompt_tokens}/{context_token_budget} tokens"
+    )
+
     # Store important user information in memory
-    user_text = update.message.text.lower()
+    user_text = user_message.lower()
     if any(keyword in user_text for keyword in ['my name is', 'i am', 'i like', 'i work', 'remember']):
         await memories.add(MemoryContent(
-            content=f"User info: {update.message.text}",
+            content=f"User info: {user_message}",
             mime_type=MemoryMimeType.TEXT,
             metadata={"timestamp": datetime.now().isoformat(), "type": "user_info"}
         ))
@@ -464,11 +571,10 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = response.chat_message.content
     logger.debug(f"Assistant response: {message}")
 
-    msgs = [message[i:i + 4096] for i in range(0, len(message), 4096)]
-    for text in msgs:
-        await send_formatted_message(update, text)
+    await send_formatted_message(update, message)
 
-    return CONVERSATION
+    # Compress the history in the background, now that the user has their answer
+    schedule_summarization(user_id, memories, chat_context)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -483,8 +589,8 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the conversation."""
     user_id = str(update.effective_user.id)
     # Reset both memories and chat context
-    memories = ListMemory()
-    chat_context = BufferedChatCompletionContext(buffer_size=10)
+    memories = new_memory()
+    chat_context = TokenBudgetChatCompletionContext(context_token_budget)
     context.chat_data["memories"] = memories
     context.chat_data["chat_context"] = chat_context
     
@@ -506,7 +612,14 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "🤖 *Bot Status*\n\n"
         f"📅 Revision: `{revision_timestamp}`\n"
         f"🔄 API Version: `{api_version}`\n"
-        f"⚙️ Engine: `{engine}`"
+        f"⚙️ Engine: `{engine}`\n"
+        f"🔎 Search cache: {search_results_cache.stats()}\n"
+        f"📄 Page cache: {search_pages_cache.stats()}\n"
+        f"🧩 Agents: {AgentManager.stats()}\n"
+        f"🚦 Model requests: {', '.join(f'{name} {throttled.stats()}' for name, throttled in throttled_clients.items())}\n"
+        f"🔀 Routing: {client.stats() if isinstance(client, ModelRouter) else 'off'}\n"
+        f"⏱️ Latency:\n{metrics.summary()}\n"
+        f"💬 Response cache: {response_cache.stats()}"
     )
     await update.message.reply_text(status_message)
     return CONVERSATION
@@ -536,6 +649,12 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.error(f"Failed to send error message: {send_error}")
 
 async def post_init_handler(application):
+    # Load the tokenizer now, its first use may download the BPE file and would block a turn
+    await asyncio.to_thread(get_encoding)
+    stock_pool.start()
+    if use_mcp:
+        logger.info("Using MCP server tools for Home Assistant integration")
+        mcp_registry.start()
     try:
             revision = os.getenv("REVISION_TIMESTAMP", "Unknown")
             message = (
@@ -551,12 +670,20 @@ async def post_init_handler(application):
             )
     except Exception as e:
         logger.error(f"Startup notification failed: {e}")
-    
+
+async def post_shutdown_handler(application):
+    await mcp_registry.stop()
+    await web_search.close()
+    stock_pool.shutdown()
+    search_results_cache.save()
+    search_pages_cache.save()
+    response_cache.save()
+
 def main() -> None:
     """Run the bot."""
     # Create the Application and pass it your bot's token.
     path = os.getenv("PERSISTENCE_PATH","./")
-    persistence = PicklePersistence(filepath=path+"jarvis_brain.pkl")
+    persistence = SqlitePersistence(filepath=path+"jarvis_brain.db")
     
     # application = Application.builder().token(telegram_token).persistence(persistence).build()
     # Initialize application with job queue
@@ -565,9 +692,12 @@ def main() -> None:
         .token(telegram_token)
         .persistence(persistence)
         .post_init(post_init_handler)
+        .post_shutdown(post_shutdown_handler)
         .concurrent_updates(True)
         .build()
     )
+    # Refuses to start if an existing pickle can't be imported, rather than running without its history
+    persistence.migrate_from_pickle(path+"jarvis_brain.pkl", application.bot)
 
     # Add conversation handler with the states INTRO and CONVERSATION
     conv_handler = ConversationHandler(
@@ -596,12 +726,12 @@ def main() -> None:
         application.run_polling()
     else:
         logger.info("Starting webhook...")
-        application.run_webhook(
+        # Same as application.run_webhook, but the server also exposes /metrics
+        run_webhook_server(
+            application,
             listen='0.0.0.0',
             port=8000,
             secret_token=telegram_webhook_token,
-            #key='private.key',
-            #cert='cert.pem',
             webhook_url=telegram_webhook_url
         )
 
@@ -0,0 +1,76 @@
+# Background discovery of MCP server tools over one persistent session, shared by every agent.
+import asyncio
+import logging
+from typing import List, Optional
+
+from autogen_ext.tools.mcp import create_mcp_server_session, mcp_server_tools
+
+logger = logging.getLogger(__name__)
+
+
+class McpToolRegistry:
+    """Keeps an MCP session open in the background and publishes its tools.
+
+    Agents read `tools` without ever waiting on the server. `version` changes whenever the
+    published tools are replaced, so holders of older tool objects know to pick up the new ones.
+    """
+
+    def __init__(self, server_params, refresh_interval: float = 3600, health_interval: float = 60, retry_delay: float = 30):
+        self.server_params = server_params
+        self.refresh_interval = refresh_interval  # Seconds between tool list refreshes
+        self.health_interval = health_interval  # Seconds between pings of the session
+        self.retry_delay = retry_delay  # Seconds to wait before reconnecting after a failure
+        self.tools: List = []
+        self.version = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="mcp-tool-registry")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _publish(self, tools: List) -> None:
+        self.tools = tools
+        self.version += 1
+        logger.info(f"Published {len(tools)} MCP tools (version {self.version})")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # The session context has to be entered and exited in this same task, so it lives here
+                async with create_mcp_server_session(self.server_params) as session:
+                    await session.initialize()
+                    self._publish(await mcp_server_tools(self.server_params, session=session))
+                    await self._watch(session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"MCP session failed: {str(e)}")
+                if self.tools:
+                    # The tools are bound to the dead session, stop handing them out
+                    self._publish([])
+                await asyncio.sleep(self.retry_delay)
+
+    async def _watch(self, session) -> None:
+        """Health check the session and refresh its tool list, raising once the session has failed."""
+        loop = asyncio.get_running_loop()
+        next_refresh = loop.time() + self.refresh_interval
+        while True:
+            await asyncio.sleep(self.health_interval)
+
+            # A failing ping raises, which tears the session down and reconnects
+            await asyncio.wait_for(session.send_ping(), timeout=self.health_interval)
+
+            if loop.time() >= next_refresh:
+                next_refresh = loop.time() + self.refresh_interval
+                tools = await mcp_server_tools(self.server_params, session=session)
+                if [(t.name, t.description) for t in tools] != [(t.name, t.description) for t in self.tools]:
+                    self._publish(tools)
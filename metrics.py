@@ -0,0 +1,147 @@
+# In-process latency histograms and counters, rendered in the Prometheus text format.
+import functools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+RECENT_SAMPLES = 1024  # Observations kept per series for the percentiles in /status
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+        return lines
+
+
+class Histogram:
+    """Cumulative bucket counts for Prometheus, plus the most recent samples for percentiles."""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+        self._recent: Dict[LabelKey, Deque[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        if key not in self._counts:
+            self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+            self._recent[key] = deque(maxlen=RECENT_SAMPLES)
+        counts = self._counts[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1  # +Inf
+        self._sums[key] += value
+        self._recent[key].append(value)
+
+    def percentiles(self, *quantiles: float) -> Dict[LabelKey, List[float]]:
+        """Percentiles of the recent samples of each series."""
+        result = {}
+        for key, recent in self._recent.items():
+            ordered = sorted(recent)
+            result[key] = [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+        return result
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in self._counts.items():
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+span_seconds = Histogram("jarvis_span_seconds", "Duration of each stage of a turn, by span")
+span_errors = Counter("jarvis_span_errors_total", "Spans that raised an error, by span")
+model_tokens = Counter("jarvis_model_tokens_total", "Tokens used by model requests, by deployment and kind")
+model_queue_seconds = Histogram("jarvis_model_queue_seconds", "Time model requests waited for the rate limits, by deployment")
+
+REGISTRY = [span_seconds, span_errors, model_tokens, model_queue_seconds]
+
+
+@contextmanager
+def span(name: str, **labels: str) -> Iterator[None]:
+    """Time a block as a span, counting it as an error if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        span_errors.inc(span=name, **labels)
+        raise
+    finally:
+        span_seconds.observe(time.perf_counter() - started, span=name, **labels)
+
+
+def timed(name: str):
+    """Decorate a coroutine function to run each call as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_tool(tool):
+    """Time every run of an autogen tool as a "tool" span, labelled with the tool name."""
+    if getattr(tool, "_instrumented", False):
+        return tool
+    run_json = tool.run_json
+
+    @functools.wraps(run_json)
+    async def timed_run_json(*args, **kwargs):
+        with span("tool", tool=tool.name):
+            return await run_json(*args, **kwargs)
+
+    tool.run_json = timed_run_json
+    tool._instrumented = True
+    return tool
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def summary() -> str:
+    """p50 and p95 of each span over the recent samples, for /status."""
+    lines = []
+    for key, (p50, p95) in sorted(span_seconds.percentiles(0.5, 0.95).items()):
+        name = " ".join(value for _, value in key if value)
+        lines.append(f"{name}: p50 {p50:.2f}s, p95 {p95:.2f}s")
+    return "\n".join(lines) or "no samples yet"
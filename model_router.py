@@ -0,0 +1,137 @@
+# Sends each model request to the small or the large deployment, depending on what the turn needs.
+import logging
+import re
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Mapping, Optional, Sequence, Union
+
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    FunctionExecutionResultMessage,
+    LLMMessage,
+    ModelCapabilities,
+    ModelInfo,
+    RequestUsage,
+    UserMessage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+SMALL = "small"
+LARGE = "large"
+
+# Which deployment the current turn was routed to, set per turn and inherited by its model requests
+model_route: ContextVar[str] = ContextVar("model_route", default=LARGE)
+
+# Words suggesting the turn needs tools, fresh facts or careful reasoning
+COMPLEX_HINTS = re.compile(
+    r"\b(search|google|latest|news|today|stock|stocks|share price|compare|analy[sz]e|explain|why|how|code|write|plan|"
+    r"calculate|turn on|turn off|switch|lights?|temperature)\b",
+    re.IGNORECASE,
+)
+
+
+def classify(message: str, max_words: int = 12) -> str:
+    """Route short small talk to the small deployment, anything that looks like real work to the large one."""
+    if len(message.split()) <= max_words and not COMPLEX_HINTS.search(message) and "```" not in message:
+        return SMALL
+    return LARGE
+
+
+class ModelRouter(ChatCompletionClient):
+    """Routes requests between a large and a small model client by the model_route contextvar.
+
+    A turn routed to the small model is moved to the large one as soon as it involves tool results,
+    so the answer built on them gets the stronger model.
+    """
+
+    def __init__(self, large: ChatCompletionClient, small: ChatCompletionClient):
+        self.large = large
+        self.small = small
+        self.routed = {SMALL: 0, LARGE: 0}  # Model requests sent to each deployment
+
+    def _route(self, messages: Sequence[LLMMessage]) -> ChatCompletionClient:
+        route = model_route.get()
+        if route == SMALL:
+            # Only this turn's messages count, i.e. those after the last user message
+            for message in reversed(messages):
+                if isinstance(message, UserMessage):
+                    break
+                if isinstance(message, FunctionExecutionResultMessage):
+                    logger.info("Turn used tools, escalating from the small to the large model")
+                    route = LARGE
+                    break
+        self.routed[route] += 1
+        return self.small if route == SMALL else self.large
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        return await self._route(messages).create(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        )
+
+    def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        return self._route(messages).create_stream(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        )
+
+    async def close(self) -> None:
+        await self.large.close()
+        await self.small.close()
+
+    def actual_usage(self) -> RequestUsage:
+        large, small = self.large.actual_usage(), self.small.actual_usage()
+        return RequestUsage(prompt_tokens=large.prompt_tokens + small.prompt_tokens, completion_tokens=large.completion_tokens + small.completion_tokens)
+
+    def total_usage(self) -> RequestUsage:
+        large, small = self.large.total_usage(), self.small.total_usage()
+        return RequestUsage(prompt_tokens=large.prompt_tokens + small.prompt_tokens, completion_tokens=large.completion_tokens + small.completion_tokens)
+
+    # Token limits are reported for the large model, every prompt has to fit it anyway
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self.large.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self.large.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self.large.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self.large.model_info
+
+    def stats(self) -> str:
+        return f"{self.routed[SMALL]} small, {self.routed[LARGE]} large"
@@ -0,0 +1,83 @@
+# Token bucket rate limiting, for pacing Telegram sends and model requests without fixed sleeps.
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows bursts of up to capacity, refilling at rate tokens per second.
+
+    Waiters are served in arrival order, so a large request can't be starved by a stream of small ones.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1) -> float:
+        """Wait until tokens are available and take them, returning how long that took."""
+        # Requests bigger than the bucket would never fit, let them through once it's full
+        tokens = min(tokens, self.capacity)
+        started = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+        return time.monotonic() - started
+
+    def adjust(self, tokens: float) -> None:
+        """Take (or give back, if negative) tokens without waiting, e.g. to correct an estimate.
+
+        The bucket can go into debt, which later acquires pay off before they're let through.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - tokens)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class ChatRateLimiter:
+    """A token bucket per chat, plus one shared by all chats for the bot's global limit."""
+
+    def __init__(self, rate: float = 1.0, burst: float = 3, global_rate: float = 30, max_chats: int = 1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def _bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.rate, self.burst)
+            self._prune()
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _prune(self) -> None:
+        # A full bucket holds no state worth keeping, so the least recently used ones can go
+        for chat_id in list(self._chats)[: max(0, len(self._chats) - self.max_chats)]:
+            if self._chats[chat_id].is_full():
+                del self._chats[chat_id]
+
+    async def acquire(self, chat_id: Hashable) -> None:
+        waited = await self._bucket(chat_id).acquire()
+        waited += await self._global.acquire()
+        if waited > 0.01:
+            logger.debug(f"Waited {waited:.2f}s to send to chat {chat_id}")
@@ -0,0 +1,175 @@
+# Answers repeated model requests from a cache instead of calling the model again.
+import hashlib
+import json
+import logging
+import re
+from typing import Any, AsyncGenerator, Mapping, Optional, Sequence, Union
+
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    AssistantMessage,
+    ChatCompletionClient,
+    CreateResult,
+    FunctionExecutionResultMessage,
+    LLMMessage,
+    ModelCapabilities,
+    ModelInfo,
+    RequestUsage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(content: Any) -> Any:
+    if isinstance(content, str):
+        return WHITESPACE.sub(" ", content).strip()
+    if isinstance(content, list):
+        return [_normalize(part) for part in content]
+    if isinstance(content, BaseModel):
+        return content.model_dump(mode="json")
+    return str(content)
+
+
+def _uses_tools(messages: Sequence[LLMMessage]) -> bool:
+    """Whether a request carries tool calls or their results."""
+    return any(
+        isinstance(m, FunctionExecutionResultMessage) or (isinstance(m, AssistantMessage) and isinstance(m.content, list))
+        for m in messages
+    )
+
+
+class CachedChatCompletionClient(ChatCompletionClient):
+    """Wraps a model client, returning the stored result when the same request was made before.
+
+    Requests are keyed by a hash of the whitespace normalized messages, the model and the request
+    parameters, including the names of the tools offered. Only plain text answers are stored, never
+    tool calls. Requests that carry tool calls or their results are passed straight through unless
+    cache_tool_turns is set, since their answers depend on the world rather than just the prompt.
+    """
+
+    def __init__(self, inner: ChatCompletionClient, cache: TTLCache, model: str = "", cache_tool_turns: bool = False):
+        self._inner = inner
+        self.cache = cache  # Stores results as JSON, so it can be persisted
+        self.model = model
+        self.cache_tool_turns = cache_tool_turns
+
+    def _key(
+        self,
+        messages: Sequence[LLMMessage],
+        tools: Sequence[Tool | ToolSchema],
+        tool_choice: Any,
+        json_output: Optional[bool | type[BaseModel]],
+        extra_create_args: Mapping[str, Any],
+    ) -> Optional[str]:
+        """The cache key for a request, or None if it shouldn't be cached."""
+        if not self.cache_tool_turns and _uses_tools(messages):
+            return None
+        if isinstance(json_output, type):
+            json_output = json_output.__name__
+        request = {
+            "model": self.model,
+            "messages": [[type(m).__name__, getattr(m, "source", None), _normalize(m.content)] for m in messages],
+            "tools": [tool["name"] if isinstance(tool, dict) else tool.name for tool in tools],
+            "tool_choice": tool_choice if isinstance(tool_choice, str) else tool_choice.name,
+            "json_output": json_output,
+            "extra_create_args": dict(extra_create_args),
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get(self, key: Optional[str]) -> Optional[CreateResult]:
+        if key is None:
+            return None
+        stored = self.cache.get(key)
+        if stored is None:
+            return None
+        logger.debug(f"Answered a model request from the cache ({self.cache.stats()})")
+        result = CreateResult.model_validate(stored)
+        result.cached = True
+        return result
+
+    def _set(self, key: Optional[str], result: CreateResult) -> None:
+        # Only complete text answers are worth repeating, a tool call has to be made again every time
+        if key is not None and result.finish_reason == "stop" and isinstance(result.content, str):
+            self.cache.set(key, result.model_dump(mode="json"))
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        key = self._key(messages, tools, tool_choice, json_output, extra_create_args)
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        result = await self._inner.create(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        )
+        self._set(key, result)
+        return result
+
+    async def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        key = self._key(messages, tools, tool_choice, json_output, extra_create_args)
+        cached = self._get(key)
+        if cached is not None:
+            yield cached.content
+            yield cached
+            return
+        async for chunk in self._inner.create_stream(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        ):
+            if isinstance(chunk, CreateResult):
+                self._set(key, chunk)
+            yield chunk
+
+    async def close(self) -> None:
+        await self._inner.close()
+
+    def actual_usage(self) -> RequestUsage:
+        return self._inner.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._inner.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._inner.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._inner.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self._inner.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._inner.model_info
@@ -0,0 +1,250 @@
+# Asynchronous Google search for the agent, enriching results with page content fetched concurrently over a shared connection pool.
+import asyncio
+import logging
+import time
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SEARCH_API_URL = "https://customsearch.googleapis.com/customsearch/v1"
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+READ_CHUNK_SIZE = 16384
+USER_AGENT = "Mozilla/5.0 (compatible; JarvisBot/1.0; +https://github.com/yusufk/jarvis-azure)"
+
+
+class WebSearch:
+    """Google Custom Search client that never blocks the event loop."""
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        search_engine_id: Optional[str],
+        per_host_limit: int = 2,
+        host_delay: float = 1.0,
+        page_timeout: float = 10.0,
+        deadline: float = 15.0,
+        max_connections: int = 20,
+        max_page_bytes: int = 1024 * 1024,
+        results_cache: Optional[TTLCache] = None,
+        pages_cache: Optional[TTLCache] = None,
+    ):
+        self.api_key = api_key
+        self.search_engine_id = search_engine_id
+        self.per_host_limit = per_host_limit  # Concurrent requests allowed per host
+        self.host_delay = host_delay  # Minimum spacing between requests to the same host
+        self.page_timeout = page_timeout
+        self.deadline = deadline  # Total time budget for fetching all result pages
+        self.max_connections = max_connections
+        self.max_page_bytes = max_page_bytes  # Hard cap on bytes read from a single page
+        self.results_cache = results_cache  # Normalised query -> search API items
+        self.pages_cache = pages_cache  # URL -> extracted page text
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._host_next_slot: Dict[str, float] = {}
+        self._host_in_flight: Dict[str, int] = {}  # Fetches holding or waiting for each host's semaphore
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared pooled HTTP client, creating it on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections // 2,
+                ),
+                timeout=httpx.Timeout(self.page_timeout, connect=5.0),
+                follow_redirects=True,
+                headers={"User-Agent": USER_AGENT},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def search(self, query: str, num_results: int = 2, max_chars: int = 500) -> str:
+        """Search Google and return the results with page content as markdown."""
+        if not self.api_key or not self.search_engine_id:
+            raise ValueError("API key or Search Engine ID not found in environment variables")
+
+        results = await self._get_results(query, num_results)
+        bodies = await self._fetch_pages([item["link"] for item in results], max_chars)
+
+        # Convert the response to a chat friendly, markdown format response
+        parts = []
+        for item, body in zip(results, bodies):
+            parts.append(f"## {item['title']}\n\n")
+            parts.append(f"**Snippet:** {item.get('snippet', '')}\n\n")
+            parts.append(f"**Content:**\n{body}\n\n")
+            parts.append("---\n\n")  # Horizontal rule between results
+        return "".join(parts)
+
+    async def _get_results(self, query: str, num_results: int) -> list:
+        cache_key = f"{num_results}:{' '.join(query.lower().split())}"
+        if self.results_cache is not None:
+            results = self.results_cache.get(cache_key)
+            if results is not None:
+                logger.debug(f"Search cache hit for '{query}'")
+                return results
+
+        params = {"key": str(self.api_key), "cx": str(self.search_engine_id), "q": str(query), "num": str(num_results)}
+        response = await self._get_client().get(SEARCH_API_URL, params=params)
+
+        if response.status_code != 200:
+            logger.debug(response.text)
+            raise Exception(f"Error in API request: {response.status_code}")
+
+        results = response.json().get("items", [])
+        if self.results_cache is not None:
+            self.results_cache.set(cache_key, results)
+        return results
+
+    async def _fetch_pages(self, urls: List[str], max_chars: int) -> List[str]:
+        """Fetch all pages concurrently, giving up on whatever is unfinished at the deadline."""
+        if not urls:
+            return []
+        tasks = [asyncio.create_task(self._polite_get_content(url, max_chars)) for url in urls]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        bodies = []
+        for url, task in zip(urls, tasks):
+            if task in done and not task.cancelled() and task.exception() is None:
+                bodies.append(task.result())
+            else:
+                logger.warning(f"Gave up fetching {url} after {self.deadline}s")
+                bodies.append("")
+        return bodies
+
+    async def _polite_get_content(self, url: str, max_chars: int) -> str:
+        """Fetch a page while respecting the per-host concurrency and spacing limits."""
+        cache_key = f"{max_chars}:{url}"
+        if self.pages_cache is not None:
+            content = self.pages_cache.get(cache_key)
+            if content is not None:
+                return content
+
+        host = urlsplit(url).hostname or ""
+        if len(self._host_semaphores) > 256:
+            self._prune_hosts()
+        semaphore = self._host_semaphores.setdefault(host, asyncio.Semaphore(self.per_host_limit))
+        self._host_in_flight[host] = self._host_in_flight.get(host, 0) + 1
+        try:
+            async with semaphore:
+                # Reserve the next free slot for this host before sleeping, so concurrent fetches stay spaced out
+                now = time.monotonic()
+                slot = max(now, self._host_next_slot.get(host, 0.0))
+                self._host_next_slot[host] = slot + self.host_delay
+                if slot > now:
+                    await asyncio.sleep(slot - now)
+                content = await self._get_page_content(url, max_chars)
+        finally:
+            self._host_in_flight[host] -= 1
+            if not self._host_in_flight[host]:
+                del self._host_in_flight[host]
+
+        # Empty content usually means a failed or skipped fetch, so let it be retried next time
+        if content and self.pages_cache is not None:
+            self.pages_cache.set(cache_key, content)
+        return content
+
+    def _prune_hosts(self) -> None:
+        """Forget idle hosts so the politeness bookkeeping doesn't grow forever."""
+        now = time.monotonic()
+        for host in list(self._host_semaphores):
+            # A semaphore only reports locked once every permit is taken, so count the fetches instead
+            if host not in self._host_in_flight and self._host_next_slot.get(host, 0.0) < now:
+                del self._host_semaphores[host]
+                self._host_next_slot.pop(host, None)
+
+    async def _get_page_content(self, url: str, max_chars: int) -> str:
+        """Stream a page, stopping as soon as enough visible text has been collected."""
+        try:
+            async with self._get_client().stream("GET", url) as response:
+                if response.status_code >= 400:
+                    logger.debug(f"Skipping {url}, status {response.status_code}")
+                    return ""
+                content_type = response.headers.get("content-type", "").lower()
+                if content_type and not any(html_type in content_type for html_type in HTML_CONTENT_TYPES):
+                    logger.debug(f"Skipping {url}, content type {content_type}")
+                    return ""
+
+                parser = VisibleTextParser(max_chars)
+                async for chunk in response.aiter_text(chunk_size=READ_CHUNK_SIZE):
+                    parser.feed(chunk)
+                    if parser.done or response.num_bytes_downloaded >= self.max_page_bytes:
+                        break
+                # Leaving the stream context closes the connection without reading the rest of the body
+                parser.close()
+                return parser.get_text()
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {str(e)}")
+            return ""
+
+
+class VisibleTextParser(HTMLParser):
+    """Incremental HTML parser that collects visible words up to a character limit."""
+
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "title", "iframe", "canvas"}
+
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.done = False
+        self._words: List[str] = []
+        self._length = 0
+        self._skip_depth = 0
+        self._pending = ""
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_pending()
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        self._flush_pending()
+        if tag in self.SKIP_TAGS and self._skip_depth > 0:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if self.done or self._skip_depth:
+            return
+        # Text may be cut mid-word at a chunk boundary, hold the last fragment back until more arrives
+        text = self._pending + data
+        self._pending = ""
+        words = text.split()
+        if words and not text[-1].isspace():
+            self._pending = words.pop()
+        self._add_words(words)
+
+    def close(self):
+        super().close()
+        self._flush_pending()
+
+    def _flush_pending(self):
+        if self._pending:
+            self._add_words([self._pending])
+            self._pending = ""
+
+    def _add_words(self, words):
+        for word in words:
+            if self.done:
+                return
+            if self._length + len(word) + 1 > self.max_chars:
+                self.done = True
+                return
+            self._words.append(word)
+            self._length += len(word) + 1
+
+    def get_text(self) -> str:
+        return " ".join(self._words)
@@ -0,0 +1,221 @@
+# Telegram bot persistence backed by SQLite, writing chats individually and loading them only when first needed.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from telegram import Bot
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._picklepersistence import _BotUnpickler
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (kind, key)
+)
+"""
+
+
+class SqlitePersistence(BasePersistence):
+    """Stores each chat's and user's data as its own row in a SQLite database in WAL mode.
+
+    Chats are only read from disk the first time an update for them arrives, and only chats whose
+    data actually changed are written back, so startup and flush cost don't grow with the number
+    of users. The write ahead log is checkpointed and the file vacuumed in the background.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        store_data: Optional[PersistenceInput] = None,
+        update_interval: float = 60,
+        compact_interval: float = 3600,
+    ):
+        super().__init__(store_data=PersistenceInput(callback_data=False) if store_data is None else store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self.compact_interval = compact_interval
+        self._db_lock = threading.Lock()
+        self._connection = self._connect()
+        self._last_compaction = time.monotonic()
+        self._compaction: Optional[asyncio.Task] = None
+        self._loads: Dict[str, asyncio.Task] = {}  # "kind:key" -> task loading that row into memory
+        self._loaded: Set[str] = set()
+        self._hashes: Dict[str, bytes] = {}  # "kind:key" -> digest of the last value read or written
+
+    def _connect(self) -> sqlite3.Connection:
+        new_database = not os.path.exists(self.filepath)
+        connection = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+        if new_database:
+            # Has to be set before the first table is created
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(SCHEMA)
+        return connection
+
+    def _execute(self, sql: str, parameters=()) -> list:
+        with self._db_lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    async def _run(self, sql: str, parameters=()) -> list:
+        return await asyncio.to_thread(self._execute, sql, parameters)
+
+    # Reading
+
+    async def _read(self, kind: str, key: str):
+        rows = await self._run("SELECT value FROM data WHERE kind = ? AND key = ?", (kind, key))
+        if not rows:
+            return None
+        self._hashes[f"{kind}:{key}"] = hashlib.sha1(rows[0][0]).digest()
+        return pickle.loads(rows[0][0])
+
+    async def _refresh(self, kind: str, key: str, data: dict) -> None:
+        """Load a row into data the first time it is needed, later calls are no-ops."""
+        row_id = f"{kind}:{key}"
+        if row_id in self._loaded:
+            return
+        # With concurrent updates several handlers can ask for the same chat at once, load it only once
+        task = self._loads.get(row_id)
+        if task is None:
+            task = self._loads[row_id] = asyncio.create_task(self._load(kind, key, data))
+            task.add_done_callback(lambda _: self._loads.pop(row_id, None))
+        await task
+
+    async def _load(self, kind: str, key: str, data: dict) -> None:
+        stored = await self._read(kind, key)
+        if stored:
+            data.update(stored)
+        self._loaded.add(f"{kind}:{key}")
+        logger.debug(f"Loaded {kind} data for {key}")
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        # Chats are loaded lazily in refresh_chat_data
+        return {}
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh("chat", str(chat_id), chat_data)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh("user", str(user_id), user_data)
+
+    async def get_bot_data(self) -> dict:
+        return await self._read("bot", "") or {}
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._run("SELECT key, value FROM data WHERE kind = ?", (f"conversation:{name}",))
+        return {tuple(json.loads(key)): pickle.loads(value) for key, value in rows}
+
+    # Writing
+
+    async def _write(self, kind: str, key: str, data) -> None:
+        value = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(value).digest()
+        row_id = f"{kind}:{key}"
+        # The application marks every chat that received an update, skip the ones that didn't change
+        if self._hashes.get(row_id) == digest:
+            return
+        await self._run("INSERT OR REPLACE INTO data (kind, key, value) VALUES (?, ?, ?)", (kind, key, value))
+        self._hashes[row_id] = digest
+        self._schedule_compaction()
+
+    async def _delete(self, kind: str, key: str) -> None:
+        await self._run("DELETE FROM data WHERE kind = ? AND key = ?", (kind, key))
+        self._hashes.pop(f"{kind}:{key}", None)
+        self._loaded.discard(f"{kind}:{key}")
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._write("chat", str(chat_id), data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._write("user", str(user_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._write("bot", "", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        if new_state is None:
+            await self._delete(f"conversation:{name}", json.dumps(list(key)))
+        else:
+            await self._write(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._delete("chat", str(chat_id))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._delete("user", str(user_id))
+
+    # Maintenance
+
+    def _compact(self) -> None:
+        with self._db_lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.execute("PRAGMA incremental_vacuum").fetchall()
+        logger.debug(f"Compacted {self.filepath}")
+
+    def _schedule_compaction(self) -> None:
+        if time.monotonic() - self._last_compaction < self.compact_interval:
+            return
+        if self._compaction is not None and not self._compaction.done():
+            return
+        self._last_compaction = time.monotonic()
+        self._compaction = asyncio.create_task(asyncio.to_thread(self._compact))
+
+    async def flush(self) -> None:
+        if self._compaction is not None:
+            await self._compaction
+        await asyncio.to_thread(self._compact)
+        with self._db_lock:
+            self._connection.close()
+
+    def migrate_from_pickle(self, pickle_path: str, bot: Bot) -> None:
+        """One off import of a single file PicklePersistence, if the database is still empty.
+
+        Raises if the file can't be imported, the database would otherwise fill up with new chats and
+        the import would never be tried again.
+        """
+        if not os.path.exists(pickle_path) or self._execute("SELECT 1 FROM data LIMIT 1"):
+            return
+        try:
+            # PicklePersistence swaps the bot for a persistent id that only its own unpickler resolves
+            with open(pickle_path, "rb") as f:
+                stored = _BotUnpickler(bot, f).load()
+            with self._db_lock:
+                self._connection.execute("BEGIN")
+                for kind, rows in (("chat", stored.get("chat_data") or {}), ("user", stored.get("user_data") or {})):
+                    for key, data in rows.items():
+                        self._connection.execute("INSERT INTO data VALUES (?, ?, ?)", (kind, str(key), pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+                if stored.get("bot_data"):
+                    self._connection.execute("INSERT INTO data VALUES (?, ?, ?)", ("bot", "", pickle.dumps(stored["bot_data"], protocol=pickle.HIGHEST_PROTOCOL)))
+                for name, conversations in (stored.get("conversations") or {}).items():
+                    for key, state in conversations.items():
+                        self._connection.execute("INSERT INTO data VALUES (?, ?, ?)", (f"conversation:{name}", json.dumps(list(key)), pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)))
+                self._connection.execute("COMMIT")
+            logger.info(f"Migrated {pickle_path} into {self.filepath}")
+        except Exception as e:
+            logger.error(f"Failed to migrate {pickle_path}: {e}")
+            with self._db_lock:
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+            raise
@@ -0,0 +1,417 @@
+# Stock analysis tool, run in a dedicated process pool so chart rendering never blocks the bot's event loop.
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from charts import ChartRenderer
+
+if TYPE_CHECKING:
+    # Workers re-import this module, keep them free of the agent framework
+    from autogen_core import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+
+def _warm_imports() -> None:
+    """Pool initializer, pay for the scientific stack imports once per worker instead of once per call."""
+    import matplotlib.backends.backend_agg  # noqa: F401
+    import matplotlib.figure  # noqa: F401
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+    import yfinance  # noqa: F401
+    import pytz  # noqa: F401
+
+
+class StockHistoryStore:
+    """Daily price history per ticker, kept under PERSISTENCE_PATH/stocks and synced incrementally."""
+
+    def __init__(self, path: str, sync_interval: float = 900.0, days: int = 365):
+        self.directory = os.path.join(path, "stocks")
+        self.sync_interval = sync_interval  # Seconds before a stored history is considered stale
+        self.days = days
+        # Parquet when pyarrow is installed, otherwise fall back to pandas' own pickle format
+        self.columnar = importlib.util.find_spec("pyarrow") is not None
+
+    def _file(self, ticker: str) -> str:
+        name = "".join(c for c in ticker.upper() if c.isalnum() or c in ".-^=")
+        return os.path.join(self.directory, f"{name}_history.{'parquet' if self.columnar else 'pkl'}")
+
+    def _read(self, file: str):
+        import pandas as pd
+        return pd.read_parquet(file) if self.columnar else pd.read_pickle(file)
+
+    def _write(self, hist, file: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Write next to the target and swap it in, another worker may be reading the same ticker
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        if self.columnar:
+            hist.to_parquet(tmp_file)
+        else:
+            hist.to_pickle(tmp_file)
+        os.replace(tmp_file, file)
+
+    @staticmethod
+    def _utc(hist):
+        """Put a history on a UTC index, yf.download returns naive dates and stock.history exchange-local ones."""
+        if hist.index.tz is None:
+            hist.index = hist.index.tz_localize("UTC")
+        else:
+            hist.index = hist.index.tz_convert("UTC")
+        return hist
+
+    def _window_start(self):
+        from datetime import datetime, timedelta
+        from pytz import timezone  # type: ignore
+        return datetime.now(timezone("UTC")) - timedelta(days=self.days)
+
+    def _load(self, ticker: str):
+        file = self._file(ticker)
+        if not os.path.exists(file):
+            return None
+        try:
+            # Files written before histories were normalised may hold naive or exchange-local dates
+            return self._utc(self._read(file))
+        except Exception as e:
+            logger.warning(f"Discarding unreadable history for {ticker}: {e}")
+            return None
+
+    def get_fresh(self, ticker: str):
+        """Return the stored history if it was synced within the sync interval, otherwise None."""
+        file = self._file(ticker)
+        if not os.path.exists(file) or time.time() - os.path.getmtime(file) >= self.sync_interval:
+            return None
+        hist = self._load(ticker)
+        if hist is None or hist.empty:
+            return None
+        return hist.loc[hist.index >= self._window_start()]
+
+    def put(self, ticker: str, hist):
+        """Trim a history to the window and store it, returning the trimmed history."""
+        hist = self._utc(hist.copy())
+        hist = hist.loc[hist.index >= self._window_start()]
+        if not hist.empty:
+            self._write(hist, self._file(ticker))
+        return hist
+
+    def get(self, ticker: str, stock):
+        """Return the last year of daily history, only downloading the days missing since the last sync."""
+        from datetime import datetime
+        import pandas as pd
+        from pytz import timezone  # type: ignore
+
+        hist = self.get_fresh(ticker)
+        if hist is not None:
+            return hist
+
+        end_date = datetime.now(timezone("UTC"))
+        hist = self._load(ticker)
+        if hist is not None and not hist.empty:
+            # Refetch from the last stored day as well, its bar may have been captured mid-session
+            new = stock.history(start=hist.index[-1].date(), end=end_date)
+            if new.empty:
+                os.utime(self._file(ticker))
+                return hist.loc[hist.index >= self._window_start()]
+            hist = pd.concat([hist, self._utc(new)])
+            hist = hist.sort_index()
+            # Compare days rather than timestamps, a bar stored from a naive download sits at UTC midnight
+            hist = hist[~hist.index.normalize().duplicated(keep="last")]
+        else:
+            hist = stock.history(start=self._window_start(), end=end_date)
+        return self.put(ticker, hist)
+
+
+def analyze_stock(ticker: str, path: str, sync_interval: float = 900.0) -> dict:  # type: ignore[type-arg]
+    """Analyze a year of stock data and plot it, runs inside a pool worker."""
+    from datetime import datetime
+    import numpy as np
+    import pandas as pd
+    import yfinance as yf
+    from pytz import timezone  # type: ignore
+
+    stock = yf.Ticker(ticker)
+
+    # Get historical data (1 year of data to ensure we have enough for 200-day MA)
+    end_date = datetime.now(timezone("UTC"))
+    hist = StockHistoryStore(path, sync_interval).get(ticker, stock)
+
+    # Ensure we have data
+    if hist.empty:
+        return {"error": "No historical data available for the specified ticker."}
+
+    # Compute basic statistics and additional metrics, stock.info is a network call so look it up once
+    try:
+        info = stock.info or {}
+    except Exception as e:
+        logger.warning(f"Failed to get info for {ticker}: {e}")
+        info = {}
+    current_price = info.get("currentPrice", hist["Close"].iloc[-1])
+    year_high = info.get("fiftyTwoWeekHigh", hist["High"].max())
+    year_low = info.get("fiftyTwoWeekLow", hist["Low"].min())
+
+    # Calculate 50-day and 200-day moving averages, the full series are reused for the plot
+    close = hist["Close"]
+    ma_50_series = close.rolling(window=50).mean()
+    ma_200_series = close.rolling(window=200).mean()
+    ma_50 = ma_50_series.iloc[-1]
+    ma_200 = ma_200_series.iloc[-1]
+
+    # Calculate YTD price change and percent change
+    ytd_start = datetime(end_date.year, 1, 1, tzinfo=timezone("UTC"))
+    ytd_data = hist.loc[ytd_start:]  # type: ignore[misc]
+    if not ytd_data.empty:
+        price_change = ytd_data["Close"].iloc[-1] - ytd_data["Close"].iloc[0]
+        percent_change = (price_change / ytd_data["Close"].iloc[0]) * 100
+    else:
+        price_change = percent_change = np.nan
+
+    # Determine trend
+    if pd.notna(ma_50) and pd.notna(ma_200):
+        if ma_50 > ma_200:
+            trend = "Upward"
+        elif ma_50 < ma_200:
+            trend = "Downward"
+        else:
+            trend = "Neutral"
+    else:
+        trend = "Insufficient data for trend analysis"
+
+    # Calculate volatility (standard deviation of daily returns)
+    daily_returns = hist["Close"].pct_change().dropna()
+    volatility = daily_returns.std() * np.sqrt(252)  # Annualized volatility
+
+    # Create result dictionary
+    result = {
+        "ticker": ticker,
+        "current_price": current_price,
+        "52_week_high": year_high,
+        "52_week_low": year_low,
+        "50_day_ma": ma_50,
+        "200_day_ma": ma_200,
+        "ytd_price_change": price_change,
+        "ytd_percent_change": percent_change,
+        "trend": trend,
+        "volatility": volatility,
+    }
+
+    # Convert numpy types to Python native types for better JSON serialization
+    for key, value in result.items():
+        if isinstance(value, np.generic):
+            result[key] = value.item()
+
+    # Generate plot, or reuse it if nothing changed since it was last drawn
+    def draw(ax):
+        ax.plot(hist.index, close, label="Close Price")
+        ax.plot(hist.index, ma_50_series, label="50-day MA")
+        ax.plot(hist.index, ma_200_series, label="200-day MA")
+        ax.set_title(f"{ticker} Stock Price (Past Year)")
+        ax.set_xlabel("Date")
+        ax.set_ylabel("Price ($)")
+        ax.legend()
+        ax.grid(True)
+
+    renderer = ChartRenderer(os.path.join(path, "stocks", "charts"))
+    result["plot_file_path"] = renderer.render(("stock", ticker.upper(), hist.index[-1].isoformat(), close.iloc[-1]), draw)
+
+    return result
+
+
+def compare_stocks(tickers: List[str], path: str, sync_interval: float = 900.0) -> dict:  # type: ignore[type-arg]
+    """Analyze several stocks at once with one bulk download and one combined plot, runs inside a pool worker."""
+    from datetime import datetime
+    import numpy as np
+    import pandas as pd
+    import yfinance as yf
+    from pytz import timezone  # type: ignore
+
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    if not tickers:
+        return {"error": "No tickers specified."}
+    store = StockHistoryStore(path, sync_interval)
+    end_date = datetime.now(timezone("UTC"))
+
+    # Serve what we can from the history store and fetch everything else in a single request
+    histories = {}
+    stale = []
+    for ticker in tickers:
+        hist = store.get_fresh(ticker)
+        if hist is None:
+            stale.append(ticker)
+        else:
+            histories[ticker] = hist
+    if stale:
+        data = yf.download(stale, start=store._window_start(), end=end_date, group_by="ticker", progress=False, threads=True, ignore_tz=False)
+        for ticker in stale:
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                hist = data[ticker]
+            else:
+                hist = data
+            hist = hist.dropna(how="all")
+            if not hist.empty:
+                histories[ticker] = store.put(ticker, hist)
+
+    missing = [ticker for ticker in tickers if ticker not in histories or histories[ticker].empty]
+    found = [ticker for ticker in tickers if ticker not in missing]
+    if not found:
+        return {"error": "No historical data available for the specified tickers."}
+
+    # One frame per field with a column per ticker, so every metric is computed for all tickers at once.
+    # Indexes are normalised to UTC dates as tickers may trade on exchanges in different timezones.
+    def field(name):
+        frame = pd.DataFrame({ticker: histories[ticker][name] for ticker in found})
+        frame.index = pd.to_datetime(frame.index, utc=True).normalize()
+        return frame.groupby(level=0).last().sort_index()
+
+    close = field("Close").ffill()
+    ma_50 = close.rolling(window=50).mean()
+    ma_200 = close.rolling(window=200).mean()
+    volatility = close.pct_change().std() * np.sqrt(252)  # Annualized volatility
+
+    ytd = close.loc[close.index >= datetime(end_date.year, 1, 1, tzinfo=timezone("UTC"))]
+    ytd_first = ytd.bfill().iloc[0] if not ytd.empty else pd.Series(np.nan, index=found)
+    ytd_change = close.iloc[-1] - ytd_first
+    ytd_percent = ytd_change / ytd_first * 100
+
+    last_50, last_200 = ma_50.iloc[-1], ma_200.iloc[-1]
+    trend = pd.Series(
+        np.select([last_50 > last_200, last_50 < last_200], ["Upward", "Downward"], default="Neutral"),
+        index=found,
+    ).where(last_50.notna() & last_200.notna(), "Insufficient data for trend analysis")
+
+    metrics = pd.DataFrame({
+        "current_price": close.iloc[-1],
+        "52_week_high": field("High").max(),
+        "52_week_low": field("Low").min(),
+        "50_day_ma": last_50,
+        "200_day_ma": last_200,
+        "ytd_price_change": ytd_change,
+        "ytd_percent_change": ytd_percent,
+        "trend": trend,
+        "volatility": volatility,
+    })
+    # Replace NaN with None so the result serialises cleanly
+    results = metrics.astype(object).where(metrics.notna(), None).to_dict(orient="index")
+
+    # Plot prices rebased to 100 so tickers at very different price levels can be compared
+    rebased = close / close.bfill().iloc[0] * 100
+
+    def draw(ax):
+        for ticker in found:
+            ax.plot(rebased.index, rebased[ticker], label=ticker)
+        ax.set_title(f"{', '.join(found)} Relative Performance (Past Year)")
+        ax.set_xlabel("Date")
+        ax.set_ylabel("Price (rebased to 100)")
+        ax.legend()
+        ax.grid(True)
+
+    renderer = ChartRenderer(os.path.join(path, "stocks", "charts"))
+    last_closes = ",".join(f"{ticker}={close[ticker].iloc[-1]}" for ticker in found)
+    plot_file_path = renderer.render(("comparison", close.index[-1].isoformat(), last_closes), draw)
+
+    result = {"stocks": results, "plot_file_path": plot_file_path}
+    if missing:
+        result["missing"] = missing
+    return result
+
+
+class StockAnalysisPool:
+    """Runs stock analysis in warm worker processes with a per-call timeout and cancellation.
+
+    A pool with a stuck or dead worker is retired: new calls go to a fresh pool, and the old one's
+    workers are terminated once the calls still running on it have finished.
+    """
+
+    def __init__(self, path: str, workers: int = 2, timeout: float = 60.0, sync_interval: float = 900.0):
+        self.path = path
+        self.sync_interval = sync_interval  # How long a stored price history is trusted without syncing
+        self.workers = workers
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._in_flight: Dict[ProcessPoolExecutor, int] = {}  # Calls running on the current and retired pools
+
+    def start(self) -> None:
+        """Create the pool and start its workers, so the first call doesn't pay for the imports."""
+        if self._pool is not None:
+            return
+        # Spawn rather than fork, forking a process that runs an event loop and threads is unsafe. Spawned
+        # workers re-import the main script, which is why the bot is started from the bare bot.py.
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_imports,
+        )
+        self._in_flight[self._pool] = 0
+        for _ in range(self.workers):
+            self._pool.submit(_noop)
+        logger.info(f"Started stock analysis pool with {self.workers} workers")
+
+    def shutdown(self) -> None:
+        for pool in list(self._in_flight):
+            self._terminate(pool)
+        self._pool = None
+
+    def _terminate(self, pool: ProcessPoolExecutor) -> None:
+        # ProcessPoolExecutor can't interrupt a running call, so terminate its workers outright
+        self._in_flight.pop(pool, None)
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _retire(self, pool: ProcessPoolExecutor) -> None:
+        """Send new calls to a fresh pool, the retired one is terminated once its calls have finished."""
+        if pool is self._pool:
+            self._pool = None
+            self.start()
+
+    async def analyze(self, ticker: str, cancellation_token: Optional["CancellationToken"] = None) -> dict:  # type: ignore[type-arg]
+        return await self._run(analyze_stock, ticker, cancellation_token)
+
+    async def compare(self, tickers: List[str], cancellation_token: Optional["CancellationToken"] = None) -> dict:  # type: ignore[type-arg]
+        return await self._run(compare_stocks, tickers, cancellation_token)
+
+    async def _run(self, func, tickers, cancellation_token: Optional["CancellationToken"]) -> dict:  # type: ignore[type-arg]
+        # A worker that died, e.g. killed for running out of memory, breaks its whole pool, retry once on a fresh one
+        for _ in range(2):
+            try:
+                return await self._call(func, tickers, cancellation_token)
+            except BrokenProcessPool as e:
+                logger.warning(f"Stock analysis pool broke while analyzing {tickers}: {e}")
+        return {"error": f"Stock analysis for {tickers} failed, the analysis workers stopped unexpectedly."}
+
+    async def _call(self, func, tickers, cancellation_token: Optional["CancellationToken"]) -> dict:  # type: ignore[type-arg]
+        self.start()
+        pool = self._pool
+        assert pool is not None
+        self._in_flight[pool] += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(pool, func, tickers, self.path, self.sync_interval)
+            if cancellation_token is not None:
+                cancellation_token.link_future(future)
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stock analysis for {tickers} timed out after {self.timeout}s")
+            self._retire(pool)
+            return {"error": f"Stock analysis for {tickers} timed out."}
+        except asyncio.CancelledError:
+            logger.info(f"Stock analysis for {tickers} was cancelled")
+            self._retire(pool)
+            raise
+        except BrokenProcessPool:
+            self._retire(pool)
+            raise
+        finally:
+            if pool in self._in_flight:
+                self._in_flight[pool] -= 1
+                if pool is not self._pool and self._in_flight[pool] == 0:
+                    self._terminate(pool)
+
+
+def _noop() -> None:
+    pass
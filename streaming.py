@@ -0,0 +1,72 @@
+# Shows a reply while it is still being generated, by editing a placeholder Telegram message as tokens arrive.
+import logging
+import time
+from typing import Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ProgressiveReply:
+    """A placeholder message that is edited with the text generated so far, at most once per interval.
+
+    Edits are plain text, since half a reply is rarely valid Markdown. Telegram throttles edits per
+    chat, so the interval is kept conservative and any RetryAfter pushes the next edit back.
+    """
+
+    def __init__(self, message: Message, interval: float = 1.5, placeholder: str = "…"):
+        self.message = message  # The user's message, the placeholder replies to it
+        self.interval = interval
+        self.placeholder = placeholder
+        self.text = ""
+        self._reply: Optional[Message] = None
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def start(self) -> None:
+        try:
+            self._reply = await self.message.reply_text(self.placeholder)
+        except TelegramError as e:
+            logger.warning(f"Failed to send the reply placeholder: {e}")
+        self._next_edit = time.monotonic() + self.interval
+
+    async def append(self, chunk: str) -> None:
+        self.text += chunk
+        if time.monotonic() >= self._next_edit:
+            await self._edit()
+
+    async def status(self, text: str) -> None:
+        """Replace the text so far with a status line, e.g. while tools run."""
+        self.text = ""
+        await self._edit(text)
+
+    async def _edit(self, text: Optional[str] = None) -> None:
+        text = (text or self.text)[:MAX_MESSAGE_LENGTH].strip()
+        if self._reply is None or not text or text == self._shown:
+            return
+        try:
+            await self._reply.edit_text(text)
+            self._shown = text
+            self._next_edit = time.monotonic() + self.interval
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.debug(f"Throttled editing the reply, next edit in {retry_after}s")
+            self._next_edit = time.monotonic() + retry_after
+        except BadRequest as e:
+            # E.g. "message is not modified", the next edit will catch up
+            logger.debug(f"Failed to edit the reply: {e}")
+            self._next_edit = time.monotonic() + self.interval
+
+    async def finish(self) -> None:
+        """Remove the placeholder, the complete reply is sent formatted in its place."""
+        if self._reply is None:
+            return
+        try:
+            await self._reply.delete()
+        except TelegramError as e:
+            logger.warning(f"Failed to delete the reply placeholder: {e}")
+        self._reply = None
@@ -0,0 +1,237 @@
+# Shares the Azure OpenAI rate limits between all users: budgets requests and tokens, queues fairly and backs off together.
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Deque, Mapping, Optional, Sequence, Tuple, Union
+
+import openai
+from autogen_core import CancellationToken
+from autogen_core.models import ChatCompletionClient, CreateResult, LLMMessage, ModelCapabilities, ModelInfo, RequestUsage
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+import metrics
+from rate_limiter import TokenBucket
+from token_context import message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Who the current model request is for, requests are queued fairly between users
+current_user: ContextVar[str] = ContextVar("current_user", default="system")
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+DEFAULT_COMPLETION_TOKENS = 500  # Assumed reply length when a request doesn't set max_tokens
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait before retrying, if it said."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # An HTTP date, fall back to our own backoff
+    return None
+
+
+class ThrottledChatCompletionClient(ChatCompletionClient):
+    """Wraps a model client so all requests share request and token per minute budgets.
+
+    Requests wait in a queue per user and are admitted round robin, so one user's burst of tool
+    calls can't hold up everyone else. A 429 pauses admission for everyone for as long as the server
+    asks, and failed requests are retried with exponential backoff and full jitter. The wrapped
+    client's own retries should be turned off, so they don't fight the shared backoff.
+    """
+
+    def __init__(
+        self,
+        inner: ChatCompletionClient,
+        name: str = "model",
+        requests_per_minute: float = 60,
+        tokens_per_minute: float = 60000,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self._inner = inner
+        self.name = name  # Labels this client's metrics, e.g. the deployment
+        # Azure enforces its per minute quotas over shorter windows, so only allow a sixth of a minute as a burst
+        self._requests = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute / 6))
+        self._tokens = TokenBucket(tokens_per_minute / 60, max(1, tokens_per_minute / 6))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttled = 0  # 429 responses received
+        self.retries = 0
+        self._paused_until = 0.0
+        self._queues: "OrderedDict[str, Deque[Tuple[asyncio.Future, int]]]" = OrderedDict()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    # Scheduling
+
+    def _estimate_tokens(self, messages: Sequence[LLMMessage], extra_create_args: Mapping[str, Any]) -> int:
+        completion = extra_create_args.get("max_completion_tokens") or extra_create_args.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        return sum(message_tokens(message) for message in messages) + completion
+
+    async def _admit(self, tokens: int) -> None:
+        """Wait for this user's turn and for the budgets to allow the request."""
+        started = time.monotonic()
+        ticket = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(current_user.get(), deque()).append((ticket, tokens))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await ticket
+            metrics.model_queue_seconds.observe(time.monotonic() - started, deployment=self.name)
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                # Admitted just as we were cancelled, hand the budget back
+                self._requests.adjust(-1)
+                self._tokens.adjust(-tokens)
+            raise
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            # Take the head of the next user's queue, and send them to the back of the line
+            user, queue = self._queues.popitem(last=False)
+            ticket, tokens = queue.popleft()
+            if queue:
+                self._queues[user] = queue
+            if ticket.done():  # Cancelled while waiting
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._requests.acquire()
+            await self._tokens.acquire(tokens)
+            if ticket.done():
+                self._requests.adjust(-1)
+                self._tokens.adjust(-tokens)
+            else:
+                ticket.set_result(None)
+
+    def _record_usage(self, estimate: int, usage: Optional[RequestUsage]) -> None:
+        # Settle the estimate against what the request actually used
+        if usage is not None:
+            metrics.model_tokens.inc(usage.prompt_tokens, deployment=self.name, kind="prompt")
+            metrics.model_tokens.inc(usage.completion_tokens, deployment=self.name, kind="completion")
+            self._tokens.adjust(usage.prompt_tokens + usage.completion_tokens - estimate)
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if isinstance(error, openai.RateLimitError):
+            # Everyone is over the limit, not just this request, so hold back all requests
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self.retries += 1
+        logger.warning(f"Model request failed ({type(error).__name__}), retrying in {delay:.1f}s, attempt {attempt + 1} of {self.max_retries}")
+        return delay
+
+    # ChatCompletionClient
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        estimate = self._estimate_tokens(messages, extra_create_args)
+        for attempt in range(self.max_retries + 1):
+            await self._admit(estimate)
+            try:
+                with metrics.span("model", deployment=self.name):
+                    result = await self._inner.create(
+                        messages,
+                        tools=tools,
+                        tool_choice=tool_choice,
+                        json_output=json_output,
+                        extra_create_args=extra_create_args,
+                        cancellation_token=cancellation_token,
+                    )
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(e, attempt))
+                continue
+            self._record_usage(estimate, result.usage)
+            return result
+        raise AssertionError("unreachable")
+
+    async def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        estimate = self._estimate_tokens(messages, extra_create_args)
+        for attempt in range(self.max_retries + 1):
+            await self._admit(estimate)
+            started = False
+            request_started = time.perf_counter()
+            try:
+                async for chunk in self._inner.create_stream(
+                    messages,
+                    tools=tools,
+                    tool_choice=tool_choice,
+                    json_output=json_output,
+                    extra_create_args=extra_create_args,
+                    cancellation_token=cancellation_token,
+                ):
+                    if not started:
+                        metrics.span_seconds.observe(time.perf_counter() - request_started, span="model_first_token", deployment=self.name)
+                    started = True
+                    if isinstance(chunk, CreateResult):
+                        metrics.span_seconds.observe(time.perf_counter() - request_started, span="model", deployment=self.name)
+                        self._record_usage(estimate, chunk.usage)
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                metrics.span_errors.inc(span="model", deployment=self.name)
+                # Once part of the reply has been passed on, a retry would repeat it
+                if started or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(e, attempt))
+
+    async def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        await self._inner.close()
+
+    def actual_usage(self) -> RequestUsage:
+        return self._inner.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._inner.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._inner.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._inner.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self._inner.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._inner.model_info
+
+    def stats(self) -> str:
+        return f"{self.throttled} throttled, {self.retries} retries, {sum(len(q) for q in self._queues.values())} queued"
@@ -0,0 +1,96 @@
+# A model context that fits the chat history into a prompt token budget, counting each message once.
+import logging
+from typing import Callable, List, Optional
+
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import FunctionExecutionResultMessage, LLMMessage
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators the chat format adds around every message
+IMAGE_TOKENS = 85  # Flat estimate for an image part
+
+
+def message_tokens(message: LLMMessage) -> int:
+    """Estimate the prompt tokens a single chat message costs."""
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_tokens(getattr(message, "thought", None) or "")
+    content = message.content
+    if isinstance(content, str):
+        return tokens + count_tokens(content)
+    for part in content:
+        if isinstance(part, str):
+            tokens += count_tokens(part)
+        elif hasattr(part, "arguments"):  # FunctionCall
+            tokens += count_tokens(part.name) + count_tokens(part.arguments)
+        elif hasattr(part, "call_id"):  # FunctionExecutionResult
+            tokens += count_tokens(part.content)
+        else:  # Image
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+class TokenBudgetChatCompletionContext(ChatCompletionContext):
+    """Chat context that only hands the model the most recent messages fitting within a token budget."""
+
+    def __init__(self, token_budget: int = 4000, initial_messages: Optional[List[LLMMessage]] = None):
+        super().__init__(initial_messages)
+        self._token_budget = token_budget
+        self._token_counts: List[int] = [message_tokens(message) for message in self._messages]
+        self.last_prompt_tokens = 0
+
+    def _sync_token_counts(self) -> None:
+        # Recount if the messages were changed behind our back, e.g. by load_state
+        if len(self._token_counts) != len(self._messages):
+            self._token_counts = [message_tokens(message) for message in self._messages]
+
+    async def add_message(self, message: LLMMessage) -> None:
+        self._sync_token_counts()
+        await super().add_message(message)
+        self._token_counts.append(message_tokens(message))
+
+    async def get_messages(self) -> List[LLMMessage]:
+        self._sync_token_counts()
+        # Walk back from the newest message until the budget is spent, always keeping the latest one
+        start = len(self._messages)
+        total = 0
+        while start > 0 and (total + self._token_counts[start - 1] <= self._token_budget or start == len(self._messages)):
+            start -= 1
+            total += self._token_counts[start]
+        # Tool results can't lead the history without the call that produced them
+        while start < len(self._messages) - 1 and isinstance(self._messages[start], FunctionExecutionResultMessage):
+            total -= self._token_counts[start]
+            start += 1
+        if start > 0:
+            logger.debug(f"Trimmed {start} messages to fit the {self._token_budget} token budget")
+        self.last_prompt_tokens = total
+        return self._messages[start:]
+
+    async def load_state(self, state) -> None:
+        await super().load_state(state)
+        self._token_counts = [message_tokens(message) for message in self._messages]
+
+    def total_tokens(self) -> int:
+        """Tokens of the full history, including messages trimmed from the prompt."""
+        self._sync_token_counts()
+        return sum(self._token_counts)
+
+    def remove_messages(self, messages: List[LLMMessage]) -> None:
+        """Remove exactly these message objects, e.g. once they have been summarized.
+
+        Matches by identity rather than position, so messages added or discarded meanwhile are left alone.
+        """
+        ids = {id(message) for message in messages}
+        self.discard_messages(lambda message: id(message) in ids)
+
+    def discard_messages(self, predicate: Callable[[LLMMessage], bool]) -> None:
+        """Remove every message matching predicate, e.g. memories injected on an earlier turn."""
+        self._sync_token_counts()
+        keep = [i for i, message in enumerate(self._messages) if not predicate(message)]
+        self._messages = [self._messages[i] for i in keep]
+        self._token_counts = [self._token_counts[i] for i in keep]
+
+    async def clear(self) -> None:
+        await super().clear()
+        self._token_counts = []
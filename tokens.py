@@ -0,0 +1,55 @@
+# Token counting with a local BPE tokenizer, shared by everything that budgets prompt size.
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "o200k_base"
+
+
+_encodings: Dict[Optional[str], Any] = {}
+_failed_at: Dict[Optional[str], float] = {}
+
+
+def get_encoding(model: Optional[str] = None):
+    """Return the tiktoken encoding for a model, or None if no tokenizer could be loaded.
+
+    tiktoken downloads the BPE file the first time an encoding is used, unless it is found under
+    TIKTOKEN_CACHE_DIR. Call this off the event loop at startup so turns find it loaded. A failed load
+    is retried after TOKENIZER_RETRY_INTERVAL seconds, until then tokens are estimated from text length.
+    """
+    if model in _encodings:
+        return _encodings[model]
+    if time.monotonic() - _failed_at.get(model, -math.inf) < float(os.getenv("TOKENIZER_RETRY_INTERVAL", 300)):
+        return None
+    import tiktoken
+
+    try:
+        encoding = None
+        if model:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Azure deployment names often aren't model names
+                pass
+        if encoding is None:
+            encoding = tiktoken.get_encoding(os.getenv("TOKENIZER_ENCODING", DEFAULT_ENCODING))
+    except Exception as e:
+        logger.warning(f"Failed to load a tokenizer, estimating tokens from text length instead: {e}")
+        _failed_at[model] = time.monotonic()
+        return None
+    _encodings[model] = encoding
+    _failed_at.pop(model, None)
+    return encoding
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,56 @@
+# Per-user work queue, so one user's messages are handled in order while different users are served in parallel.
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+class UserWorkQueue:
+    """Serialises turns per user, optionally coalescing messages that arrive while a turn is in flight."""
+
+    def __init__(self, coalesce: bool = True):
+        self.coalesce = coalesce
+        self.coalesced = 0  # Messages merged into another message's turn
+        self._pending: Dict[str, List[Any]] = {}
+        self._running: Set[str] = set()
+
+    async def submit(self, user_id: str, item: Any, handler: Callable[[List[Any]], Awaitable[None]]) -> None:
+        """Queue an item for the user and, if no turn is in flight, work through the queue.
+
+        The handler is called with a batch of items, a single one unless coalescing merged several.
+        Items submitted while a turn is in flight are handed to the call that is already working
+        through this user's queue, so this returns straight away for them.
+        """
+        if user_id in self._running:
+            self._pending.setdefault(user_id, []).append(item)
+            logger.debug(f"Queued message for user {user_id} behind the turn in flight")
+            return
+
+        self._running.add(user_id)
+        first_error = None
+        try:
+            batch = [item]
+            while batch:
+                try:
+                    await handler(batch)
+                except Exception as e:
+                    # Keep going so queued messages aren't lost, the first error is raised once the queue is drained
+                    logger.error(f"Error handling a turn for user {user_id}: {e}")
+                    first_error = first_error or e
+                batch = self._next_batch(user_id)
+        finally:
+            self._running.discard(user_id)
+            self._pending.pop(user_id, None)
+        if first_error is not None:
+            raise first_error
+
+    def _next_batch(self, user_id: str) -> List[Any]:
+        pending = self._pending.pop(user_id, [])
+        if not pending or self.coalesce:
+            if len(pending) > 1:
+                self.coalesced += len(pending) - 1
+                logger.info(f"Coalesced {len(pending)} messages from user {user_id} into one turn")
+            return pending
+        if len(pending) > 1:
+            self._pending[user_id] = pending[1:]
+        return pending[:1]
@@ -0,0 +1,164 @@
+# Long term memory that only puts the memories relevant to the current message into the prompt.
+import logging
+import re
+import time
+import zlib
+from typing import Any, List, Optional
+
+import numpy as np
+from autogen_core import CancellationToken
+from autogen_core.memory import Memory, MemoryContent, MemoryQueryResult, UpdateContextResult
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import SystemMessage, UserMessage
+
+logger = logging.getLogger(__name__)
+
+MEMORY_HEADER = "\nRelevant memory content"
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def embed(text: str, dim: int) -> np.ndarray:
+    """Embed text locally by hashing its words and word pairs into a fixed size, unit length vector."""
+    words = WORD_PATTERN.findall(text.lower())
+    features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    vector = np.zeros(dim, dtype=np.float32)
+    if not features:
+        return vector
+    # crc32 rather than hash(), which is salted per process and would break persisted vectors
+    hashes = np.array([zlib.crc32(feature.encode()) for feature in features], dtype=np.uint64)
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, (hashes % dim).astype(np.intp), signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorMemory(Memory):
+    """Memory backed by a brute force cosine similarity index over local embeddings.
+
+    Only the top k memories relevant to the latest user message are added to the model context,
+    along with the most recent conversation summary. Near duplicate memories replace the older
+    entry, and entries are evicted by age and, beyond max_entries, oldest first.
+    """
+
+    def __init__(
+        self,
+        k: int = 5,
+        max_entries: int = 500,
+        max_age_days: float = 180,
+        dedup_threshold: float = 0.9,
+        min_score: float = 0.1,
+        dim: int = 512,
+    ):
+        self.k = k
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 3600
+        self.dedup_threshold = dedup_threshold  # Similarity above which a new memory replaces an old one
+        self.min_score = min_score  # Similarity below which a memory isn't considered relevant
+        self.dim = dim
+        self._contents: List[MemoryContent] = []
+        self._added: List[float] = []  # Epoch seconds each memory was added
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+
+    @classmethod
+    def from_contents(cls, contents: List[MemoryContent], **kwargs: Any) -> "VectorMemory":
+        """Build a memory from existing contents, e.g. those of a ListMemory."""
+        memory = cls(**kwargs)
+        for content in contents:
+            memory._add(content)
+        memory._evict()
+        return memory
+
+    @property
+    def content(self) -> List[MemoryContent]:
+        return self._contents
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    async def add(self, content: MemoryContent, cancellation_token: Optional[CancellationToken] = None) -> None:
+        self._add(content)
+        self._evict()
+
+    def _add(self, content: MemoryContent) -> None:
+        vector = embed(str(content.content), self.dim)
+        if len(self._contents):
+            similarities = self._vectors @ vector
+            match = int(np.argmax(similarities))
+            if similarities[match] >= self.dedup_threshold:
+                # Keep the newer wording and freshen it, rather than storing the same fact twice
+                logger.debug(f"Replacing near duplicate memory: {self._contents[match].content}")
+                self._remove([match])
+        self._contents.append(content)
+        self._added.append(time.time())
+        self._vectors = np.vstack([self._vectors, vector[np.newaxis, :]])
+
+    def _remove(self, indices: List[int]) -> None:
+        drop = set(indices)
+        keep = [i for i in range(len(self._contents)) if i not in drop]
+        self._contents = [self._contents[i] for i in keep]
+        self._added = [self._added[i] for i in keep]
+        self._vectors = self._vectors[keep]
+
+    def _evict(self) -> None:
+        cutoff = time.time() - self.max_age
+        expired = [i for i, added in enumerate(self._added) if added < cutoff]
+        overflow = len(self._contents) - len(expired) - self.max_entries
+        if overflow > 0:
+            # Entries are kept in insertion order, so the oldest survivors come first
+            expired += [i for i in range(len(self._contents)) if i not in set(expired)][:overflow]
+        if expired:
+            self._remove(expired)
+
+    async def query(
+        self,
+        query: str | MemoryContent = "",
+        cancellation_token: Optional[CancellationToken] = None,
+        **kwargs: Any,
+    ) -> MemoryQueryResult:
+        k = kwargs.get("k", self.k)
+        text = str(query.content) if isinstance(query, MemoryContent) else query
+        if not self._contents or not text:
+            return MemoryQueryResult(results=[])
+        scores = self._vectors @ embed(text, self.dim)
+        top = np.argsort(-scores)[:k] if len(scores) > k else np.argsort(-scores)
+        results = []
+        for i in top:
+            if scores[i] < self.min_score:
+                break
+            content = self._contents[i]
+            results.append(content.model_copy(update={"metadata": {**(content.metadata or {}), "score": float(scores[i])}}))
+        return MemoryQueryResult(results=results)
+
+    def _latest_summary(self) -> Optional[MemoryContent]:
+        for content in reversed(self._contents):
+            if (content.metadata or {}).get("type") == "summary":
+                return content
+        return None
+
+    async def update_context(self, model_context: ChatCompletionContext) -> UpdateContextResult:
+        messages = await model_context.get_messages()
+        query = next((m.content for m in reversed(messages) if isinstance(m, UserMessage) and isinstance(m.content, str)), "")
+        results = (await self.query(query)).results
+
+        # The latest summary carries the thread of the conversation, so it is always included
+        summary = self._latest_summary()
+        if summary is not None and all(result.content != summary.content for result in results):
+            results.append(summary)
+
+        # Memories added on earlier turns are stale now, drop them rather than letting them pile up
+        if hasattr(model_context, "discard_messages"):
+            model_context.discard_messages(lambda m: isinstance(m, SystemMessage) and m.content.startswith(MEMORY_HEADER))
+
+        if results:
+            memory_strings = [f"{i}. {str(memory.content)}" for i, memory in enumerate(results, 1)]
+            memory_context = MEMORY_HEADER + ":\n" + "\n".join(memory_strings) + "\n"
+            await model_context.add_message(SystemMessage(content=memory_context))
+        return UpdateContextResult(memories=MemoryQueryResult(results=results))
+
+    async def clear(self) -> None:
+        self._contents = []
+        self._added = []
+        self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+
+    async def close(self) -> None:
+        pass
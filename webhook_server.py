@@ -0,0 +1,76 @@
+# Serves the Telegram webhook and the /metrics route from one tornado server, in place of run_webhook.
+import asyncio
+import json
+import logging
+import signal
+from typing import Optional
+
+import tornado.httpserver
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram: Application, secret_token: Optional[str]) -> None:
+        self.telegram = telegram
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.secret_token and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            logger.warning("Rejected a webhook request with a missing or wrong secret token")
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.telegram.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Rejected a webhook request with an invalid body: {e}")
+            raise tornado.web.HTTPError(400)
+        await self.telegram.update_queue.put(update)
+        self.set_status(200)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+def run_webhook_server(application: Application, port: int, webhook_url: str, secret_token: Optional[str] = None, listen: str = "0.0.0.0") -> None:
+    """Run the application on a webhook like Application.run_webhook, also serving GET /metrics."""
+    asyncio.run(_serve(application, port, webhook_url, secret_token, listen))
+
+
+async def _serve(application: Application, port: int, webhook_url: str, secret_token: Optional[str], listen: str) -> None:
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/metrics", MetricsHandler),
+        (r"/", TelegramWebhookHandler, dict(telegram=application, secret_token=secret_token)),
+    ]))
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    # The same lifecycle run_webhook goes through, including the post_* hooks
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        # run_webhook leaves allowed_updates unset, so Telegram keeps sending the update types it did before
+        await application.bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=None)
+        await application.start()
+        server.listen(port, listen)
+        logger.info(f"Serving the webhook and /metrics on port {port}")
+        await stopping.wait()
+    finally:
+        server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)